@@ -0,0 +1,208 @@
+"""
+Offline benchmark of the bot's event handlers. Replays synthetic traffic against fake servers, channels and members and
+an in-memory storage, and reports throughput, handler latency, storage queries and Discord REST calls per event.
+
+Usage (from the repository root):
+    python benchmarks/benchmark.py --guilds 50 --queues 2 --events 20000 --rest-latency 0.005
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import discord  # noqa: E402
+
+from fakes import Calls, CountingStorage, FakeGuild, FakeMessage, FakeTextChannel  # noqa: E402
+from QueueManager import QueueManager  # noqa: E402
+from admission import REJECTED  # noqa: E402
+from search_index import SearchIndex  # noqa: E402
+
+
+class Server:
+    """
+    A fake server with queue channels, an archive channel, students and managers.
+    """
+
+    def __init__(self, index: int, rest: Calls, queues: int, students: int, managers: int):
+        self.guild = FakeGuild(f"server-{index}", rest)
+        self.archive = self.guild.add_channel('archive')
+        self.queues = [self.guild.add_channel(f"questions-{i}") for i in range(queues)]
+        self.manager_role = self.guild.add_role('TA')
+        self.students = [self.guild.add_member(f"student-{i}") for i in range(students)]
+        self.managers = [self.guild.add_member(f"ta-{i}", [self.manager_role]) for i in range(managers)]
+
+
+class Workload:
+    """
+    Generates a random mix of events, based on the current state of the fake servers.
+    """
+
+    def __init__(self, bot: QueueManager, servers: List[Server], mix: Dict[str, float], seed: int):
+        self.bot = bot
+        self.servers = servers
+        self.kinds = list(mix)
+        self.weights = [mix[k] for k in self.kinds]
+        self.random = random.Random(seed)
+
+    def _questions(self, channel: FakeTextChannel, emoji: str) -> List[FakeMessage]:
+        return [m for m in channel.messages.values() if m.guild.me in m.reactions.get(emoji, ())]
+
+    def next(self):
+        """
+        @return: Tuple[str, coroutine]: The name of the handler and the call to it
+        """
+        server = self.random.choice(self.servers)
+        channel = self.random.choice(server.queues)
+        kind = self.random.choices(self.kinds, self.weights)[0]
+        if kind == 'claim' and (open_questions := self._questions(channel, '📥')):
+            question = self.random.choice(open_questions)
+            manager = self.random.choice(server.managers)
+            return 'on_raw_reaction_add', self.bot.on_raw_reaction_add(question.react('📥', manager))
+        if kind == 'archive' and (claimed := self._questions(channel, '📤')):
+            question = self.random.choice(claimed)
+            owner_id = self.bot.claims.get_owner(question.id)
+            member = server.guild.get_member(owner_id) if owner_id is not None and self.random.random() < 0.9 \
+                else self.random.choice(server.managers + [question.author])
+            return 'on_raw_reaction_add', self.bot.on_raw_reaction_add(question.react('📤', member))
+        if kind == 'reply' and (open_questions := self._questions(channel, '📥') + self._questions(channel, '📤')):
+            question = self.random.choice(open_questions)
+            manager = self.random.choice(server.managers)
+            message = channel.post(manager, "Have you tried turning it off and on again?", reference=question)
+            return 'on_message', self.bot.on_message(message)
+        if kind == 'voice':
+            message = channel.post(self.random.choice(server.students), f"vc {self.random.randint(1, 9)}")
+            return 'on_message', self.bot.on_message(message)
+        # A question, or a follow-up when the student posted last
+        message = channel.post(self.random.choice(server.students),
+                               "How do I fix this error? " * self.random.randint(1, 10))
+        return 'on_message', self.bot.on_message(message)
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def print_latency(name: str, values: List[float]) -> None:
+    print(f"  {name:<20} n={len(values):<7} mean={statistics.mean(values) * 1000:8.3f} ms  "
+          f"p50={percentile(values, 50) * 1000:8.3f} ms  p99={percentile(values, 99) * 1000:8.3f} ms")
+
+
+async def run(args) -> None:
+    rest = Calls(args.rest_latency)
+    db = Calls(args.db_latency)
+    storage = CountingStorage(db)
+    servers = [Server(i, rest, args.queues, args.students, args.managers) for i in range(args.guilds)]
+    for server in servers:
+        await storage.set_archive(server.guild.id, server.archive.id)
+        await storage.set_queues(server.guild.id, {q.id for q in server.queues})
+        await storage.set_roles(server.guild.id, {server.manager_role.id})
+
+    search_index = SearchIndex(':memory:') if args.search_index else None
+    bot = QueueManager(storage=storage, search_index=search_index, command_prefix='?',
+                       intents=discord.Intents.default())
+    if not args.rate_limits:  # The fakes have no rate limits, so by default requests are not spaced out either
+        bot.outbound.limits = {}
+    bot.outbound.embed_window = args.archive_batch_window
+    bot._connection.user = servers[0].guild.me
+    for server in servers:
+        server.guild.client = bot
+        bot._connection._guilds[server.guild.id] = server.guild
+
+    async def change_presence(**_):
+        pass
+    bot.change_presence = change_presence
+
+    start = time.perf_counter()
+    await bot.on_shard_ready(0)
+    await bot.on_ready()
+    await bot.reconciler.wait()
+    startup = time.perf_counter() - start
+    rest.counts.clear()
+    db.counts.clear()
+
+    mix = dict(kind.split('=') for kind in args.mix.split(','))
+    workload = Workload(bot, servers, {k: float(v) for k, v in mix.items()}, args.seed)
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def handle(name, call):
+        async with semaphore:
+            t = time.perf_counter()
+            await call
+            latencies[name].append(time.perf_counter() - t)
+
+    # Questions are archived in the background, after the reaction was handled
+    archives: List[float] = []
+    archive_isolated = bot._archive_isolated
+
+    async def timed_archive(*args):
+        t = time.perf_counter()
+        await archive_isolated(*args)
+        archives.append(time.perf_counter() - t)
+    bot._archive_isolated = timed_archive
+
+    tasks = []
+    start = time.perf_counter()
+    for _ in range(args.events):
+        name, call = workload.next()
+        await semaphore.acquire()  # Don't generate events faster than they are handled
+        semaphore.release()
+        tasks.append(asyncio.ensure_future(handle(name, call)))
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    await bot.close()
+
+    events = args.events
+    print(f"Startup (on_ready): {startup * 1000:.1f} ms")
+    print(f"Events: {events} in {elapsed:.2f} s -> {events / elapsed:.0f} events/s")
+    print("Handler latency:")
+    for name, values in sorted(latencies.items()):
+        print_latency(name, values)
+    if archives:
+        print("Archive latency (until posted and removed from the queue):")
+        print_latency('archive', archives)
+    for name, count in sorted(REJECTED.values.items()):
+        print(f"Rejected {name[0]} events: {count:.0f}")
+    print(f"Storage queries: {db.total()} ({db.total() / events:.3f} per event)")
+    for name, count in db.counts.most_common():
+        print(f"  {name:<24} {count}")
+    print(f"Discord REST calls: {rest.total()} ({rest.total() / events:.3f} per event)")
+    for name, count in rest.counts.most_common():
+        print(f"  {name:<24} {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--guilds', type=int, default=10, help="Number of servers")
+    parser.add_argument('--queues', type=int, default=2, help="Queue channels per server")
+    parser.add_argument('--students', type=int, default=50, help="Students per server")
+    parser.add_argument('--managers', type=int, default=5, help="Managers per server")
+    parser.add_argument('--events', type=int, default=5000, help="Number of events to replay")
+    parser.add_argument('--mix', default='question=0.45,reply=0.15,voice=0.05,claim=0.2,archive=0.15',
+                        help="Relative frequency of each kind of event")
+    parser.add_argument('--concurrency', type=int, default=10, help="Events handled at the same time")
+    parser.add_argument('--rest-latency', type=float, default=0.0, help="Simulated seconds per Discord REST call")
+    parser.add_argument('--rate-limits', action='store_true',
+                        help="Space out Discord REST calls to stay within Discord's rate limits, like in production")
+    parser.add_argument('--archive-batch-window', type=float, default=0.0,
+                        help="Seconds archived questions wait to be posted together (0: post each on its own)")
+    parser.add_argument('--search-index', action='store_true', help="Index archived questions for the search command")
+    parser.add_argument('--db-latency', type=float, default=0.0, help="Simulated seconds per storage query")
+    parser.add_argument('--seed', type=int, default=0)
+    asyncio.get_event_loop().run_until_complete(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+"""
+In-process stand-ins for the discord.py objects and the storage used by the bot, so the event handlers can be driven
+without a Discord gateway or a database. Every call that would be a Discord REST request or a database query is counted
+and can be given an artificial latency.
+"""
+import asyncio
+import itertools
+from collections import Counter
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+import discord
+
+from storage import MemoryStorage
+
+_snowflakes = itertools.count(discord.utils.time_snowflake(datetime.utcnow() - timedelta(hours=1)))
+
+
+def snowflake() -> int:
+    return next(_snowflakes)
+
+
+class Calls:
+    """
+    Counts calls by name, e.g. Discord REST routes or storage methods, and simulates their latency.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.counts: Counter = Counter()
+
+    async def __call__(self, name: str) -> None:
+        self.counts[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+
+class FakeRole:
+    def __init__(self, guild: 'FakeGuild', name: str):
+        self.id = snowflake()
+        self.guild = guild
+        self.name = name
+        self.mention = f"<@&{self.id}>"
+
+
+class FakeMember(discord.Member):
+    # Shadow the slots and properties of discord.Member with plain attributes.
+    id = name = display_name = discriminator = mention = avatar_url = bot = guild = roles = None
+
+    def __init__(self, guild: 'FakeGuild', name: str, roles: List[FakeRole] = (), bot: bool = False):
+        self.id = snowflake()
+        self.guild = guild
+        self.name = self.display_name = name
+        self.discriminator = '0001'
+        self.mention = f"<@{self.id}>"
+        self.avatar_url = f"https://cdn.example/{self.id}.png"
+        self.bot = bot
+        self.roles = [guild.default_role, *roles] if guild.default_role is not None else list(roles)
+
+    def __str__(self):
+        return f"{self.name}#{self.discriminator}"
+
+    def __repr__(self):
+        return f"<FakeMember {self.name}>"
+
+
+class FakeMessage(discord.Message):
+    # Shadow the slots and properties of discord.Message with plain attributes.
+    id = channel = guild = author = content = reference = mentions = created_at = reactions = _state = None
+
+    def __init__(self, channel: 'FakeTextChannel', author: FakeMember, content: str,
+                 reference: Optional['FakeMessage'] = None, mentions: List[FakeMember] = ()):
+        self.id = snowflake()
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.reference = None if reference is None else \
+            SimpleNamespace(message_id=reference.id, channel_id=channel.id, resolved=reference)
+        self.mentions = list(mentions)
+        self.created_at = datetime.utcnow()
+        self.reactions: Dict[str, List[FakeMember]] = {}
+
+    def __repr__(self):
+        return f"<FakeMessage {self.id} by {self.author.name}>"
+
+    @property
+    def calls(self) -> Calls:
+        return self.channel.guild.calls
+
+    async def add_reaction(self, emoji: str) -> None:
+        await self.calls('add_reaction')
+        self.reactions.setdefault(emoji, []).append(self.guild.me)
+
+    async def remove_reaction(self, emoji: str, member: FakeMember) -> None:
+        await self.calls('remove_reaction')
+        if self.id not in self.channel.messages:
+            raise discord.NotFound(SimpleNamespace(status=404, reason='Not Found'), 'Unknown Message')
+        if member in self.reactions.get(emoji, []):
+            self.reactions[emoji].remove(member)
+
+    async def clear_reaction(self, emoji: str) -> None:
+        await self.calls('clear_reaction')
+        self.reactions.pop(emoji, None)
+
+    async def clear_reactions(self) -> None:
+        await self.calls('clear_reactions')
+        self.reactions.clear()
+
+    async def delete(self) -> None:
+        await self.calls('delete_message')
+        self.channel.remove([self.id])
+
+    async def reply(self, content: str) -> 'FakeMessage':
+        return await self.channel.send(content, reference=self)
+
+    def react(self, emoji: str, member: FakeMember) -> SimpleNamespace:
+        """
+        Add a reaction as a user would, without a REST call.
+        @return: SimpleNamespace: The payload of the raw reaction event
+        """
+        self.reactions.setdefault(emoji, []).append(member)
+        return SimpleNamespace(guild_id=self.guild.id, channel_id=self.channel.id, message_id=self.id,
+                               user_id=member.id, member=member, emoji=emoji, event_type='REACTION_ADD')
+
+
+class FakePartialMessage:
+    def __init__(self, channel: 'FakeTextChannel', message_id: int):
+        self.channel = channel
+        self.guild = channel.guild
+        self.id = message_id
+        self.created_at = discord.utils.snowflake_time(message_id)
+
+    def _message(self) -> FakeMessage:
+        try:
+            return self.channel.messages[self.id]
+        except KeyError:
+            raise discord.NotFound(SimpleNamespace(status=404, reason='Not Found'), 'Unknown Message')
+
+    async def delete(self) -> None:
+        await self.channel.guild.calls('delete_message')
+        self._message()
+        self.channel.remove([self.id])
+
+    async def add_reaction(self, emoji: str) -> None:
+        await self.channel.guild.calls('add_reaction')
+        self._message().reactions.setdefault(emoji, []).append(self.channel.guild.me)
+
+    async def remove_reaction(self, emoji: str, member: FakeMember) -> None:
+        await self.channel.guild.calls('remove_reaction')
+        reactions = self._message().reactions.get(emoji, [])
+        if member in reactions:
+            reactions.remove(member)
+
+    async def clear_reaction(self, emoji: str) -> None:
+        await self.channel.guild.calls('clear_reaction')
+        self._message().reactions.pop(emoji, None)
+
+    async def clear_reactions(self) -> None:
+        await self.channel.guild.calls('clear_reactions')
+        self._message().reactions.clear()
+
+    async def reply(self, content: str) -> FakeMessage:
+        return await self.channel.send(content, reference=self._message())
+
+    async def fetch(self) -> FakeMessage:
+        await self.channel.guild.calls('get_message')
+        return self._message()
+
+
+class FakeTextChannel:
+    def __init__(self, guild: 'FakeGuild', name: str):
+        self.id = snowflake()
+        self.guild = guild
+        self.name = name
+        self.mention = f"<#{self.id}>"
+        self.messages: Dict[int, FakeMessage] = {}  # In the order they were sent
+        # Direct API requests, used to send several embeds in one message
+        self._state = SimpleNamespace(http=SimpleNamespace(request=self._request),
+                                      create_message=lambda channel, data: data)
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return f"<FakeTextChannel {self.name}>"
+
+    def permissions_for(self, member: FakeMember) -> discord.Permissions:
+        return discord.Permissions.text()
+
+    def get_partial_message(self, message_id: int) -> FakePartialMessage:
+        return FakePartialMessage(self, message_id)
+
+    def post(self, author: FakeMember, content: str, **kwargs) -> FakeMessage:
+        """
+        Post a message as a user would, without a REST call.
+        """
+        message = FakeMessage(self, author, content, **kwargs)
+        self.messages[message.id] = message
+        return message
+
+    async def send(self, content: Optional[str] = None, *, embed: Optional[discord.Embed] = None,
+                   reference: Optional[FakeMessage] = None) -> FakeMessage:
+        await self.guild.calls('send_message')
+        message = self.post(self.guild.me, content or '', reference=reference)
+        self.guild.dispatch('on_message', message)
+        return message
+
+    async def _request(self, route, json: dict) -> FakeMessage:
+        await self.guild.calls('send_message')
+        message = self.post(self.guild.me, '')
+        self.guild.dispatch('on_message', message)
+        return message
+
+    async def delete_messages(self, messages) -> None:
+        await self.guild.calls('bulk_delete_messages' if len(messages) > 1 else 'delete_message')
+        self.remove([m.id for m in messages])
+
+    def remove(self, message_ids: List[int]) -> None:
+        removed = [m_id for m_id in message_ids if self.messages.pop(m_id, None) is not None]
+        if len(removed) == 1:
+            self.guild.dispatch('on_raw_message_delete',
+                                SimpleNamespace(channel_id=self.id, message_id=removed[0], guild_id=self.guild.id))
+        elif removed:
+            self.guild.dispatch('on_raw_bulk_message_delete',
+                                SimpleNamespace(channel_id=self.id, message_ids=set(removed), guild_id=self.guild.id))
+
+    async def history(self, limit: Optional[int] = 100, after: Optional[FakeMessage] = None):
+        await self.guild.calls('get_messages')
+        messages = list(self.messages.values())
+        if after is not None:  # Oldest first
+            messages = [m for m in messages if m.id > after.id][:limit]
+        else:  # Newest first
+            messages = messages[::-1][:limit]
+        for message in messages:
+            yield message
+
+
+class FakeGuild:
+    def __init__(self, name: str, calls: Calls):
+        self.id = snowflake()
+        self.name = name
+        self.calls = calls
+        self.client = None
+        self.default_role = None
+        self.default_role = FakeRole(self, '@everyone')
+        self.me = FakeMember(self, 'QueueManager', bot=True)
+        self.channels: Dict[int, FakeTextChannel] = {}
+        self.roles: Dict[int, FakeRole] = {self.default_role.id: self.default_role}
+        self.members: Dict[int, FakeMember] = {self.me.id: self.me}
+        self.unavailable = False
+        self.shard_id = 0
+
+    def __repr__(self):
+        return f"<FakeGuild {self.name}>"
+
+    def add_channel(self, name: str) -> FakeTextChannel:
+        channel = FakeTextChannel(self, name)
+        self.channels[channel.id] = channel
+        return channel
+
+    def add_role(self, name: str) -> FakeRole:
+        role = FakeRole(self, name)
+        self.roles[role.id] = role
+        return role
+
+    def add_member(self, name: str, roles: List[FakeRole] = ()) -> FakeMember:
+        member = FakeMember(self, name, roles)
+        self.members[member.id] = member
+        return member
+
+    def get_channel(self, channel_id: int) -> Optional[FakeTextChannel]:
+        return self.channels.get(channel_id)
+
+    def get_role(self, role_id: int) -> Optional[FakeRole]:
+        return self.roles.get(role_id)
+
+    def get_member(self, member_id: int) -> Optional[FakeMember]:
+        return self.members.get(member_id)
+
+    async def fetch_member(self, member_id: int) -> FakeMember:
+        await self.calls('get_member')
+        try:
+            return self.members[member_id]
+        except KeyError:
+            raise discord.NotFound(SimpleNamespace(status=404, reason='Not Found'), 'Unknown Member')
+
+    def dispatch(self, event: str, *args) -> None:
+        """
+        Deliver a gateway event caused by a REST call to the bot, like Discord would.
+        """
+        if self.client is not None:
+            self.client.dispatch(event[3:], *args)
+
+
+class CountingStorage(MemoryStorage):
+    """
+    In-memory storage that counts its queries and simulates their latency.
+    """
+
+    def __init__(self, calls: Calls):
+        super().__init__()
+        self.calls = calls
+
+
+def _counted(name: str):
+    method = getattr(MemoryStorage, name)
+
+    async def counted(self, *args, **kwargs):
+        await self.calls(name)
+        return await method(self, *args, **kwargs)
+    counted.__name__ = name
+    return counted
+
+
+for _name in ('get_servers', 'set_archive', 'set_queues', 'set_roles', 'set_rules', 'delete_server', 'get_claims',
+              'write_claims'):
+    setattr(CountingStorage, _name, _counted(_name))
@@ -1,33 +1,107 @@
-from typing import Set, Dict, Optional, Union
-import discord
 import asyncio
-from discord import Reaction, User, Member, Embed, Message, Guild, TextChannel, Role
+import sqlite3
+from typing import Set, Dict, Optional, List, Tuple
+import discord
+from discord import Member, Embed, Message, PartialMessage, PartialEmoji, Guild, TextChannel, Role
 from discord.ext import commands
-import re
+from sys import stderr
 
 from server_conf import ServerConfiguration
-from database_connection import execute_query
-from config import config
+from storage import Storage, create_storage
+from claims import ClaimTable
+from recent_messages import RecentMessages
+from member_cache import MemberCache
+from threads import QuestionThreads
+from actions import gather_isolated, detach, add_fields
+from outbound import Outbound, HIGH, NORMAL, LOW
+from scheduler import Scheduler
+from reconciler import Reconciler
+from search_index import SearchIndex
+from stats import QueueStats
+from admission import Admission, admitted
+from rules import ACK, ARCHIVE, IGNORE
+import metrics
+from config import config, SHARD_COUNT, SHARD_IDS, MAX_MESSAGES, MEMBER_CACHE, MEMBER_CACHE_SIZE, MEMBER_TTL, \
+    ARCHIVE_BATCH_WINDOW, RECONCILE_LIMIT, RECONCILE_CONCURRENCY, SEARCH_INDEX_PATH, ADMISSION_CONCURRENCY, \
+    ADMISSION_QUEUE, DEGRADE_LATENCY, RELEASE
 
-RELEASE = True
-TOKEN, PREFIX = config(release=RELEASE)
 
-
-class QueueManager(commands.Bot):
-    def __init__(self, **kwargs):
+class QueueManager(commands.AutoShardedBot):
+    def __init__(self, storage: Storage, search_index: Optional[SearchIndex] = None, **kwargs):
         super().__init__(**kwargs)
-        # Keeps track of server configurations in a session to limit the amount of database traffic.
-        self.server_confs: Dict[Guild, ServerConfiguration] = {}
+        # The bot runs the given shards (all of them by default), and only keeps state for the servers of those shards.
+        self._ready_shards: Set[int] = set()  # Shards whose servers are loaded
+        self._started = False
+        self.archiving: Set[int] = set()  # Questions that are being archived
+        self.archive_tasks: Set[asyncio.Task] = set()
+        # Limits the messages and reactions handled per server at the same time, and tracks overloaded servers
+        self.admission = Admission(ADMISSION_CONCURRENCY, ADMISSION_QUEUE, DEGRADE_LATENCY,
+                                   backlog=lambda guild_id: self.outbound.backlog(guild_id))
+        self.storage = storage  # Persistent server configurations and claimed messages
+        self.search_index = search_index  # Full-text index of archived questions, if enabled
+        self.claims = ClaimTable(storage)  # Owners of claimed messages, persisted to the storage in batches
+        self.members = MemberCache(MEMBER_CACHE_SIZE, MEMBER_TTL)  # Members the bot deals with, in lean mode
+        # Latest authors in each queue channel, to detect chains
+        self.recent_messages = RecentMessages(size=15, on_author=self.members.add)
+        self.threads = QuestionThreads()  # Open questions and the messages that belong to them
+        self.stats = QueueStats()  # Waiting questions and waiting times per queue channel
+        # Pipelines per channel for the requests that change messages
+        self.outbound = Outbound(embed_window=ARCHIVE_BATCH_WINDOW)
+        self.scheduler = Scheduler(self.outbound)  # Deferred deletes and reaction removals
+        # Checks the claims from a previous session against the queue channels
+        self.reconciler = Reconciler(self.claims, self.outbound, RECONCILE_LIMIT, RECONCILE_CONCURRENCY)
+        # Server configurations by server ID. All are loaded at once when the bot logs in, so that handling events
+        # never has to wait for the database.
+        self.server_confs: Dict[int, ServerConfiguration] = {}
+        metrics.instrument_http(self.http)
+        metrics.Gauge('queuemanager_scheduled_actions', "Deferred actions waiting in the scheduler",
+                      lambda: len(self.scheduler))
+        metrics.Gauge('queuemanager_outbound_queue', "Discord requests waiting in the outbound pipelines",
+                      lambda: len(self.outbound))
+        metrics.Gauge('queuemanager_pending_claims', "Claim changes not yet written to the storage",
+                      lambda: self.claims.pending)
+        metrics.Gauge('queuemanager_claims', "Claimed messages", lambda: len(self.claims.owners))
+        metrics.Gauge('queuemanager_open_questions', "Indexed questions that are not archived",
+                      lambda: len(self.threads.threads))
+        metrics.Gauge('queuemanager_waiting_questions', "Questions that are not claimed or archived yet",
+                      lambda: len(self.stats.waiting))
+        metrics.Gauge('queuemanager_admission_queue', "Events waiting for their turn to be handled",
+                      lambda: len(self.admission))
+        metrics.Gauge('queuemanager_degraded_servers', "Overloaded servers for which non-essential work is skipped",
+                      lambda: sum(gate.degraded for gate in self.admission.gates.values()))
+        metrics.Gauge('queuemanager_servers', "Servers with a loaded configuration", lambda: len(self.server_confs))
+        metrics.Gauge('queuemanager_cached_members', "Members in the member cache", lambda: len(self.members))
 
     def get_server_conf(self, server: Guild) -> ServerConfiguration:
         """
-        Set the ServerConfiguration for the given server
+        Get the ServerConfiguration for the given server
         @param server: discord.Guild: The server for which to retrieve the configuration
-        @return: ServerConfiguration: The configuration
+        @return: ServerConfiguration: The configuration, or an empty one if it is not loaded (yet)
+        """
+        try:
+            return self.server_confs[server.id]
+        except KeyError:  # Not kept, so the stored configuration is used once loading it succeeds
+            return ServerConfiguration(server)
+
+    async def load_server_confs(self, servers: List[Guild]) -> None:
+        """
+        Load the configurations of the given servers from the storage with a single query.
+        @param servers: List[discord.Guild]: The servers to load the configuration of
+        @return:
         """
-        if server not in self.server_confs:
-            self.server_confs[server] = ServerConfiguration(server)
-        return self.server_confs[server]
+        records = await self.storage.get_servers(server.id for server in servers)
+        for server in servers:
+            self.server_confs[server.id] = ServerConfiguration(server, records.get(server.id))
+
+    async def load_claims(self, servers: List[Guild]) -> None:
+        """
+        Load the claimed messages of the given servers from the storage with a single query, and start reconciling them
+        with the queue channels of those servers. Their configurations must be loaded first.
+        @param servers: List[discord.Guild]: The servers to load the claimed messages of
+        @return:
+        """
+        await self.claims.load(server.id for server in servers)
+        self.reconciler.start(q for s in servers for q in self.get_queue_channels(s))
 
     def get_queue_channels(self, guild: Guild) -> Set[TextChannel]:
         """
@@ -51,16 +125,59 @@ class QueueManager(commands.Bot):
         @param member: discord.Member: The member to check
         @return: bool: Whether is member is a queue manager or not
         """
-        manager_roles = self.get_manager_roles(member.guild)
-        return len(set(member.roles) & manager_roles) > 0  # Intersect is non-empty means they have a manager role.
+        return self.get_server_conf(member.guild).is_manager(member)
 
-    async def archive(self, message: Message, reaction: Reaction) -> None:
+    async def fetch_question(self, message: PartialMessage) -> Optional[Message]:
+        """
+        Get a message from the message cache, or request it from Discord if it is not cached.
+        @param message: discord.PartialMessage: The message
+        @return: Optional[discord.Message]: The message, or None if it was deleted
         """
-        Archive the given message by sending it in the archive channel and removing it from the queue.
-        @param message: discord.Message: The message to archive
-        @param reaction: discord.Reaction: Reaction that triggered the archive event
+        cached = self._connection._get_message(message.id)
+        if cached is not None:
+            return cached
+        try:
+            return await message.fetch()
+        except discord.NotFound:
+            return None
+
+    async def get_question(self, message: PartialMessage) -> Optional[Tuple[int, str]]:
+        """
+        Get the author and content of a question. These are known without a request if the question is indexed.
+        @param message: discord.PartialMessage: The question
+        @return: Optional[Tuple[int, str]]: ID of the author and the content, or None if the message was deleted
+        """
+        if (thread := self.threads.get(message.id)) is not None:
+            return thread.author_id, thread.content
+        if (full := await self.fetch_question(message)) is not None:
+            return full.author.id, full.content
+        return None
+
+    def archive(self, message: PartialMessage, member: Member, emoji: PartialEmoji) -> None:
+        """
+        Archive the given message in the background by sending it in the archive channel and removing it from the queue.
+        Nothing happens if the message is already being archived, e.g. because two managers reacted at the same time.
+        @param message: discord.PartialMessage: The message to archive
+        @param member: discord.Member: The member that reacted to archive the message
+        @param emoji: discord.PartialEmoji: The emoji the member reacted with
         @return:
         """
+        if message.id in self.archiving:
+            return
+        self.archiving.add(message.id)
+        task = self.loop.create_task(self._archive_isolated(message, member, emoji))
+        self.archive_tasks.add(task)
+        task.add_done_callback(self.archive_tasks.discard)
+
+    async def _archive_isolated(self, message: PartialMessage, member: Member, emoji: PartialEmoji) -> None:
+        try:
+            await self._archive(message, member, emoji)
+        except Exception as e:
+            print(f"Could not archive question {message.id}: {e!r}", file=stderr)
+        finally:
+            self.archiving.discard(message.id)
+
+    async def _archive(self, message: PartialMessage, member: Member, emoji: PartialEmoji) -> None:
         # Get the archive channel
         try:
             channel = message.guild.get_channel(self.get_server_conf(message.guild).archive.id)
@@ -70,187 +187,480 @@ class QueueManager(commands.Bot):
             if not channel.permissions_for(message.guild.me).send_messages:
                 raise ValueError  # Channel exists, but the bot can't send messages in there.
         except (TypeError, AttributeError, ValueError) as e:
-            reactor: Optional[Member] = None
-            async for user in reaction.users():  # Find the manager that tried to archive this message to mention them.
-                if user == self.user:
-                    continue
-                reactor = user
-                break
-            await reaction.remove(reactor)
             if type(e) == ValueError:
-                m = await message.channel.send("**I don't have permission to send messages in the archive channel!**")
+                notice = self.outbound.send(message.channel,
+                                            "**I don't have permission to send messages in the archive channel!**",
+                                            priority=HIGH)
             else:
-                m = await message.channel.send(
-                    f"{reactor.mention} There is not yet an archive channel for this server. "
-                    f"Use the `{PREFIX}archive` command in the channel you wish to use as "
-                    f"archive.")
-            await asyncio.sleep(7)
-            await m.delete()
+                notice = self.outbound.send(message.channel,
+                                            f"{member.mention} There is not yet an archive channel for this server. "
+                                            f"Use the `{self.command_prefix}archive` command in the channel you wish "
+                                            f"to use as archive.", priority=HIGH)
+            _, m = await gather_isolated(self.outbound.remove_reaction(message, emoji, member, HIGH), notice)
+            self.scheduler.delete_sent_later(m, 7)
             return
 
+        # The author and content of indexed questions are known, only request the message if it is not indexed. The
+        # thread is kept until the question is archived, so it can be archived again if posting fails.
+        thread = self.threads.get(message.id)
+        full: Optional[Message] = None
+        if thread is not None:
+            name, tag, avatar_url, content = thread.author_name, thread.author_tag, thread.author_avatar_url, \
+                thread.content
+        else:
+            if (full := await self.fetch_question(message)) is None:
+                return  # The question was deleted in the meantime
+            name, tag, avatar_url, content = full.author.display_name, str(full.author), str(full.author.avatar_url), \
+                full.content
+
         # Create the embed to send in the archive channel
-        author = message.author
-        embed = Embed(title=f"Question by {author.display_name} ({author.name}#{author.discriminator}) in "
-                            f"#{message.channel}",
+        embed = Embed(title=f"Question by {name} ({tag}) in #{message.channel}",
                       timestamp=message.created_at,
                       colour=0xeeeeee)
-        embed.set_thumbnail(url=author.avatar_url)
-        embed.add_field(name=f"{author.display_name}:", value=message.content, inline=False)
+        embed.set_thumbnail(url=avatar_url)
+        author = f"{name} ({tag})"
+        fields = [(f"{name}:", content)]
 
         # Look for relevant messages to include in the archive.
+        if thread is not None:  # Messages that belong to this question were indexed as they were sent
+            to_delete = [message.id]
+            for m_id, _, field_name, field_value in thread.messages():
+                fields.append((field_name, field_value))
+                to_delete.append(m_id)
+        else:  # The question was asked before the bot started, search the channel history instead
+            to_delete = [message.id] + await self.archive_from_history(full, fields)
+
+        # Long questions continue in more embeds. If batching is enabled, they are posted in a batch with others after a
+        # short wait. Only remove the question from the queue once it is archived, so it is not lost if posting fails.
+        archived = await gather_isolated(*(self.outbound.send_embed(channel, e) for e in add_fields(embed, fields)))
+        if None in archived:
+            return
+        self.threads.pop(message.id)
+        await gather_isolated(*(self.outbound.delete(message.channel, m_id) for m_id in to_delete))
+
+        self.claims.unclaim(message.id)
+        self.stats.archived(message.id, message.channel.id)
+        if self.search_index is not None:
+            await self.index_question(message, author, fields, archived[0])
+
+    async def index_question(self, question: PartialMessage, author: str, fields: List[Tuple[str, str]],
+                             archived: Message) -> None:
+        """
+        Add an archived question to the search index. The text is taken from its archive fields, so no requests are
+        made.
+        @param question: discord.PartialMessage: The question
+        @param author: str: The name and tag of the author of the question
+        @param fields: List[Tuple[str, str]]: The names and values of the fields of the archive
+        @param archived: discord.Message: The (first) message in the archive channel
+        @return:
+        """
+        content = '\n'.join(f"{name} {value}" for name, value in fields)
+        try:
+            await self.search_index.add(question.guild.id, str(question.channel), author,
+                                        question.created_at, content, archived.jump_url)
+        except Exception as e:
+            print(f"Could not index archived question {question.id}: {e!r}", file=stderr)
+
+    async def archive_from_history(self, message: Message, fields: List[Tuple[str, str]]) -> List[int]:
+        """
+        Add the messages that belong to a question that is not indexed to its archive fields.
+        @param message: discord.Message: The question
+        @param fields: List[Tuple[str, str]]: The names and values of the fields of the archive
+        @return: List[int]: IDs of the messages that were added, to be deleted
+        """
+        author = message.author
+        added: List[int] = []
         async for m in message.channel.history(after=message, limit=100):  # Look in history from `message` to now
             if m.author == message.guild.me:  # Ignore the bot
                 continue
             if m.author == author:  # Add messages from the same user to the chain
-                embed.add_field(name=f"{m.author.display_name}:", value=m.content, inline=False)
-                await m.delete()
+                fields.append((f"{m.author.display_name}:", m.content))
+                added.append(m.id)
             elif m.reference is not None:  # Add messages that reply to the question's author
                 if isinstance(ref := m.reference.resolved, Message) and ref.author == author:
-                    embed.add_field(name=f"{m.author.display_name} replied:", value=m.content, inline=False)
-                    await m.delete()
+                    fields.append((f"{m.author.display_name} replied:", m.content))
+                    added.append(m.id)
             elif author in m.mentions:
                 # Add messages that mention the author of the question
-                embed.add_field(name=f"{m.author.display_name}:", value=m.content, inline=False)
-                await m.delete()
-
-        await message.delete()
-        await channel.send(embed=embed)
-
-        # Delete message from database
-        execute_query("DELETE FROM messages WHERE messageid = %s", (str(message.id),))
+                fields.append((f"{m.author.display_name}:", m.content))
+                added.append(m.id)
+        return added
 
     # Bot event handlers:
 
+    @metrics.timed_handler
     async def on_ready(self):
         """
-        Event handler. Triggered when the bot logs in.
+        Event handler. Triggered when all shards of the bot are ready, at login and after a shard reconnected.
         @return:
         """
-        print(f"Logged in as {self.user}")
-        await self.change_presence(activity=discord.Activity(type=discord.ActivityType.listening, name=f"{PREFIX}help"))
-        if RELEASE:
-            execute_query("DELETE FROM messages;")  # Delete all remaining messages from a previous session.
+        print(f"Logged in as {self.user} with shards {sorted(self.shards)}")
+        self._ready_shards.update(self.shards)
+        await self.change_presence(activity=discord.Activity(type=discord.ActivityType.listening,
+                                                             name=f"{self.command_prefix}help"))
+        if self._started:
+            return
+        self._started = True
+        self.claims.start()
+        self.scheduler.start()
+        await metrics.start()
+        metrics.startup_phase('ready')
+
+    @metrics.timed_handler
+    async def on_shard_connect(self, shard_id: int):
+        """
+        Event handler. Triggered when a shard (re)connects and its servers are about to be sent again.
+        @param shard_id: int: The shard
+        @return:
+        """
+        self._ready_shards.discard(shard_id)
+
+    @metrics.timed_handler
+    async def on_shard_ready(self, shard_id: int):
+        """
+        Event handler. Triggered when all servers of a shard are available after it (re)connected. Loads the
+        configurations and claimed messages of those servers in one query each, then reconciles the claims with the
+        queue channels in the background.
+        @param shard_id: int: The shard
+        @return:
+        """
+        servers = [server for server in self.guilds if server.shard_id == shard_id]
+        # Messages may have been sent while the shard was disconnected
+        queue_ids = {q.id for s in servers if (conf := self.server_confs.get(s.id)) is not None for q in conf.queues}
+        self.recent_messages.forget_channels(queue_ids)
+        self.threads.forget_channels(queue_ids)
+        self.stats.forget_channels(queue_ids)
+        delay = 1
+        while True:  # Until the storage is reachable again
+            try:
+                await self.load_server_confs(servers)
+                await self.load_claims(servers)
+                break
+            except (ConnectionError, TimeoutError, sqlite3.OperationalError) as e:
+                print(f"Could not load the servers of shard {shard_id}, retrying in {delay} s: {e!r}", file=stderr)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+            except Exception as e:  # Retrying won't help, e.g. because the database schema is outdated
+                print(f"Could not load the servers of shard {shard_id}: {e!r}", file=stderr)
+                raise
+        self._ready_shards.add(shard_id)
+
+    async def close(self):
+        """
+        Finish the questions that are being archived and execute the remaining deferred actions, log out and close all
+        connections, then write the remaining claims and close the storage.
+        @return:
+        """
+        await asyncio.gather(*self.archive_tasks)
+        await self.scheduler.close()
+        await self.outbound.close()
+        await super().close()
+        await self.claims.close()
+        await self.storage.close()
+        if self.search_index is not None:
+            await self.search_index.close()
+
+    @metrics.timed_handler
+    async def on_guild_join(self, guild: Guild):
+        """
+        Event handler. Triggered when the bot joins a server.
+        @param guild: discord.Guild: The server
+        @return:
+        """
+        await self.load_server_confs([guild])
+
+    @metrics.timed_handler
+    async def on_guild_available(self, guild: Guild):
+        """
+        Event handler. Triggered when a server becomes available. Servers that are available when their shard connects
+        are loaded by on_shard_ready; reload those that were unavailable at the time, as their channels and roles were
+        unknown.
+        @param guild: discord.Guild: The server
+        @return:
+        """
+        if guild.shard_id in self._ready_shards:
+            await self.load_server_confs([guild])
+            await self.load_claims([guild])
+
+    @metrics.timed_handler
+    async def on_guild_remove(self, guild: Guild):
+        """
+        Event handler. Triggered when the bot leaves a server, or is removed from it.
+        @param guild: discord.Guild: The server
+        @return:
+        """
+        self.server_confs.pop(guild.id, None)
+        self.admission.forget(guild.id)
+
+    @metrics.timed_handler
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        """
+        Event handler. Triggered when a channel is deleted; forget it if it was the archive or a queue.
+        @param channel: discord.abc.GuildChannel: The deleted channel
+        @return:
+        """
+        if (conf := self.server_confs.get(channel.guild.id)) is not None:
+            conf.remove_channel(channel.id)
+
+    @metrics.timed_handler
+    async def on_guild_role_delete(self, role: Role):
+        """
+        Event handler. Triggered when a role is deleted; forget it if it was a manager role.
+        @param role: discord.Role: The deleted role
+        @return:
+        """
+        if (conf := self.server_confs.get(role.guild.id)) is not None:
+            conf.remove_role(role.id)
+
+    @metrics.timed_handler
+    async def on_member_update(self, before: Member, after: Member):
+        """
+        Event handler. Triggered when a member changes, e.g. when they get or lose a role.
+        @param before: discord.Member: The member before the change
+        @param after: discord.Member: The member after the change
+        @return:
+        """
+        if before.roles != after.roles:
+            self.members.remove(after.guild.id, after.id)
+            if (conf := self.server_confs.get(after.guild.id)) is not None:
+                conf.forget_member(after.id)
+
+    @metrics.timed_handler
+    async def on_member_remove(self, member: Member):
+        """
+        Event handler. Triggered when a member leaves a server.
+        @param member: discord.Member: The member that left
+        @return:
+        """
+        self.members.remove(member.guild.id, member.id)
+        if (conf := self.server_confs.get(member.guild.id)) is not None:
+            conf.forget_member(member.id)
 
     async def on_command_error(self, context, exception):
         """
-        Event handler. Triggered when a command raises an exception. Ignore CommandNotFound, raise exception otherwise.
+        Event handler. Triggered when a command raises an exception. Ignore CommandNotFound, tell the user if the
+        storage failed, raise exception otherwise.
         @param context: discord.ext.commands.Context: The context of the command
         @param exception: Exception: The exception that was raised
         @return:
         """
         if type(exception) in [commands.CommandNotFound, commands.NoPrivateMessage]:
             return
+        if isinstance(exception, commands.CommandInvokeError) and \
+                isinstance(exception.original, (ConnectionError, sqlite3.Error)):
+            await context.send("**Could not reach the database, please try again later.**")
         raise exception
 
-    async def on_message(self, message: discord.Message):
+    @metrics.timed_handler
+    @admitted(lambda message: message.guild.id if message.guild is not None else None)
+    async def on_message(self, message: discord.Message, shed: bool = False):
         """
         Event handler. Triggered when a message is sent in a channel visible to the bot.
         @param message: discord.Message: The message that is sent.
+        @param shed: bool: Whether the server is too busy; only the bookkeeping is done then, without requests to
+        Discord, and the question is marked at low priority
         @return:
         """
+        metrics.startup_phase('first_event')
         if message.guild is None:  # Message is a DM
             await self.process_commands(message)
             return
+        is_queue = message.channel in self.get_queue_channels(message.guild)
+        if is_queue:  # Keep track of who posted last in each queue
+            if self.admission.degraded(message.guild.id):  # Don't wait for it, chains are detected as well as possible
+                detach(self.recent_messages.backfill(message.channel))
+            elif not shed:
+                await self.recent_messages.backfill(message.channel)
+            self.recent_messages.add(message.channel.id, message.id, message.author.id)
         if message.author.id == self.user.id:  # The bot should not react to its own message
             return
-        # The bot should not be concerned with any channel that is not a queue, and should not react to manager roles.
-        if message.channel not in self.get_queue_channels(message.guild) or self.is_manager(message.author):
+        if not is_queue:  # The bot should not be concerned with any channel that is not a queue
             await self.process_commands(message)
             return
+        if isinstance(message.author, Member):
+            self.members.add(message.author)
+        if not await self.is_new_question(message, shed):
+            self.threads.attach(message)
+        elif (action := self.get_server_conf(message.guild).classify(message.content)) != IGNORE:
+            # Classify the question now, so what to do when it is claimed is known by then
+            self.threads.open(message).action = action
+            self.stats.asked(message.id, message.channel.id)
+            detach(self.outbound.add_reaction(message, '📥', LOW if shed else NORMAL))
+        await self.process_commands(message)
+
+    async def is_new_question(self, message: Message, shed: bool = False) -> bool:
+        """
+        Determine if a message in a queue channel is a new question, rather than a message by a manager, a reply,
+        or the continuation of a previous question.
+        @param message: discord.Message: The message in the queue channel
+        @param shed: bool: Whether members that are not cached may not be requested
+        @return: bool: Whether the message is a new question
+        """
+        if self.is_manager(message.author):  # The bot should not react to manager roles.
+            return False
         if message.reference is not None:  # If this is a reply to a message it's not a new question
-            return
+            return False
         for mention in message.mentions:
             if not self.is_manager(mention):  # Mentions another student, likely not a new question
-                return
+                return False
 
-        chain = False  # This is not the continuation of a previous message until proven otherwise
-        async for prev_message in message.channel.history(limit=15):  # Look in message history for chain
-            if prev_message == message:  # Don't look at the current message
+        for message_id, author_id in self.recent_messages.recent(message.channel.id):  # Look for a chain
+            if message_id == message.id:  # Don't look at the current message
                 continue
-            if prev_message.author == message.author:
-                chain = True  # This is a continuation of a previous message.
-                break
-            member = message.guild.get_member(prev_message.author.id)
-            if self.is_manager(member) or member == message.guild.me:
+            if author_id == message.author.id:
+                return False  # This is a continuation of a previous message.
+            if author_id == message.guild.me.id:
+                continue
+            manager = self.get_server_conf(message.guild).is_manager_id(author_id)
+            if manager is None:  # Author was not seen recently, or not since the manager roles were last changed
+                if shed or self.admission.degraded(message.guild.id):
+                    break  # Don't wait for a request, assume they are not a manager
+                member = await self.members.fetch(message.guild, author_id)
+                manager = member is not None and self.is_manager(member)
+            if manager:
                 continue
             break
-        if chain:
-            return
+        return True
 
-        await message.add_reaction('📥')
-        await self.process_commands(message)
+    @metrics.timed_handler
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        """
+        Event handler. Triggered when a message is deleted, whether or not it is in the message cache.
+        @param payload: discord.RawMessageDeleteEvent: The deleted message
+        @return:
+        """
+        self.recent_messages.remove(payload.channel_id, payload.message_id)
+        self.threads.remove(payload.message_id)
+        self.claims.unclaim(payload.message_id)
+        self.stats.removed(payload.message_id)
+
+    @metrics.timed_handler
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        """
+        Event handler. Triggered when messages are deleted in bulk, whether or not they are in the message cache.
+        @param payload: discord.RawBulkMessageDeleteEvent: The deleted messages
+        @return:
+        """
+        for message_id in payload.message_ids:
+            self.recent_messages.remove(payload.channel_id, message_id)
+            self.threads.remove(message_id)
+            self.claims.unclaim(message_id)
+            self.stats.removed(message_id)
 
-    async def on_reaction_add(self, reaction: Reaction, member: Union[Member, User]):
+    @metrics.timed_handler
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
         """
-        Event handler. Triggers when a reaction is added to the message
-        @param reaction: discord.Reaction: Reaction object
-        @param member: discord.Member or discord.User: Member that added the reaction (Or User if in a DM)
+        Event handler. Triggered when a message is edited, whether or not it is in the message cache.
+        @param payload: discord.RawMessageUpdateEvent: The edited message
         @return:
         """
-        if not isinstance(member, Member) or member == reaction.message.guild.me or \
-                reaction.message.channel not in self.get_queue_channels(reaction.message.guild):
-            return  # Reaction is in a DM, or the bot added the reaction, or the reaction is not in a queue channel.
-        if not self.is_manager(member) and reaction.emoji != '📤':  # Not a manager
-            await reaction.remove(member)
+        if 'content' in payload.data:  # Keep the content of indexed questions up to date for the archive
+            self.threads.edit(payload.message_id, payload.data['content'])
+            if (thread := self.threads.get(payload.message_id)) is not None and \
+                    (guild := self.get_guild(int(payload.data.get('guild_id', 0)))) is not None:
+                thread.action = self.get_server_conf(guild).classify(thread.content)
+
+    @metrics.timed_handler
+    @admitted(lambda payload: payload.guild_id, droppable=False)
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+        """
+        Event handler. Triggered when a reaction is added to a message, whether or not it is in the message cache.
+        @param payload: discord.RawReactionActionEvent: The reaction, the message it was added to and the member that
+        added it
+        @return:
+        """
+        metrics.startup_phase('first_event')
+        if payload.guild_id is None or payload.user_id == self.user.id:
+            return  # Reaction is in a DM, or the bot added the reaction
+        guild = self.get_guild(payload.guild_id)
+        if guild is None or (channel := guild.get_channel(payload.channel_id)) not in self.get_queue_channels(guild):
+            return  # The reaction is not in a queue channel
+        member = payload.member
+        self.members.add(member)
+        message = channel.get_partial_message(payload.message_id)
+        emoji = str(payload.emoji)
+        # Changes to the messages are not waited for, so the next reactions of the server are not held up by the rate
+        # limits. Their errors are logged.
+        if not self.is_manager(member) and emoji != '📤':  # Not a manager
+            detach(self.outbound.remove_reaction(message, payload.emoji, member))
             return
-        if reaction.emoji == '❌':
-            await reaction.message.delete()
-            execute_query("DELETE FROM messages WHERE messageid = %s", (str(reaction.message.id),))
+        if emoji == '❌':
+            detach(self.outbound.delete(channel, message.id))
+            self.claims.unclaim(message.id)
             return
-        if reaction.emoji == '📥':  # Manager clicked to claim this message.
-            if len(c := reaction.message.content) < 60 and \
-                    re.search(r'(voice|vc|channel|chat|v|inactivacti)\s*\d+', c.lower()) is not None:
-                await reaction.message.clear_reactions()
-                await reaction.message.add_reaction('👍')
-                await asyncio.sleep(6)
-                await reaction.message.delete()  # Not worthy of the archive
+        if emoji == '📥':  # Manager clicked to claim this message.
+            if (thread := self.threads.get(message.id)) is not None:  # Classified when it was asked
+                action = thread.action
+            elif (question := await self.get_question(message)) is not None:
+                action = self.get_server_conf(guild).classify(question[1])
+            else:
+                return  # The question was deleted in the meantime
+            if action == ACK:  # Not worthy of the archive
+                detach(self.outbound.clear_reaction(message, '📥', HIGH),
+                       self.outbound.add_reaction(message, '👍', HIGH))
+                self.scheduler.delete_later(channel, message.id, 6)
                 return
-            await reaction.message.clear_reactions()
-            await reaction.message.add_reaction('📤')
-            await reaction.message.add_reaction('❌')
-            result = execute_query("INSERT IGNORE INTO messages "
-                                   "(messageid, ownerid) VALUES (%s, %s)",
-                                   (str(reaction.message.id), str(member.id)),
-                                   return_cursor_count=True)  # Set manager as owner of this question.
-            if result > 0:  # Rows changed: message wasn't yet claimed; could happen in a split second.
-                reply = await reaction.message.reply(f"{member.mention} will answer your question.")
-                await asyncio.sleep(5)
-                await reply.delete()
-        elif reaction.emoji == '📤':  # Manager or author clicked to archive this message.
-            if member != reaction.message.author and not self.is_manager(member):
-                await reaction.remove(member)
+            # Set manager as owner of this question. Could already be claimed by another manager in a split second.
+            claimed = self.claims.claim(message.id, member.id, guild.id, channel.id)
+            if claimed:
+                self.stats.claimed(message.id, channel.id)
+            if action == ARCHIVE:  # Answered by claiming it
+                if claimed:
+                    self.archive(message, member, payload.emoji)
                 return
-            if member != reaction.message.author:
-                result = execute_query("SELECT ownerid FROM messages WHERE messageid = %s",
-                                       (str(reaction.message.id),),
-                                       return_result=True)
-                try:
-                    owner_id = result[0][0]
-                except IndexError:
-                    await reaction.message.clear_reactions()
-                    await reaction.message.add_reaction('📥')
-                    return
-                if owner_id != str(member.id):  # If the manager did not claim the message they need to confirm.
-                    await reaction.remove(member)
-                    await reaction.message.add_reaction('✅')
-                    await asyncio.sleep(4)
-                    try:
-                        await reaction.message.remove_reaction('✅', self.user)  # They did not confirm.
-                    except discord.errors.NotFound:  # They confirmed.
-                        pass
+            # Swap the reactions and let the author know who will answer, all at the same time. The reply is skipped
+            # when the server is overloaded.
+            detach(self.outbound.clear_reaction(message, '📥', HIGH),
+                   self.outbound.add_reactions(message, ['📤', '❌'], HIGH))
+            if claimed and not self.admission.degraded(guild.id):
+                detach(self.outbound.reply(message, f"{member.mention} will answer your question.", HIGH),
+                       then=lambda reply: self.scheduler.delete_sent_later(reply, 5))
+        elif emoji == '📤':  # Manager or author clicked to archive this message.
+            if message.id in self.archiving:
+                return  # The question is about to disappear
+            is_manager = self.is_manager(member)
+            owner_id = self.claims.get_owner(message.id)
+            if not is_manager or owner_id != member.id:  # Anyone but the owner: check if they are the author
+                if (question := await self.get_question(message)) is None:
+                    return  # The question was deleted in the meantime
+                if member.id != question[0]:
+                    if not is_manager:
+                        detach(self.outbound.remove_reaction(message, payload.emoji, member))
+                        return
+                    if owner_id is None:
+                        detach(self.outbound.clear_reactions(message, HIGH),
+                               self.outbound.add_reaction(message, '📥', HIGH))
+                        return
+                    # If the manager did not claim the message they need to confirm.
+                    detach(self.outbound.remove_reaction(message, payload.emoji, member, HIGH),
+                           self.outbound.add_reaction(message, '✅', HIGH))
+                    # Take the confirmation away if they did not confirm. If they did, the message is archived by then.
+                    if not self.admission.degraded(guild.id):  # Otherwise it stays until the question is archived
+                        self.scheduler.remove_reaction_later(channel, message.id, '✅', self.user, 4)
                     return
-            await self.archive(reaction.message, reaction)
-        elif reaction.emoji == '✅':
-            await self.archive(reaction.message, reaction)
+            self.archive(message, member, payload.emoji)
+        elif emoji == '✅':
+            self.archive(message, member, payload.emoji)
         else:  # Remove any other reactions than those mentioned above.
-            await reaction.remove(member)
+            detach(self.outbound.remove_reaction(message, payload.emoji, member))
             return
 
 
 if __name__ == "__main__":
+    metrics.startup_phase('imported')
+    token, prefix = config(release=RELEASE)
     intents = discord.Intents.default()
-    intents.members = True  # Need the members intent to use guild.get_member in on_message
-    client = QueueManager(command_prefix=PREFIX, intents=intents)
+    if MEMBER_CACHE == 'full':  # Cache all members of every server, and receive their role changes
+        member_options = {}
+        intents.members = True
+    else:  # Only cache the members the bot deals with. Authors and reactors are included in the events.
+        member_options = {'chunk_guilds_at_startup': False, 'member_cache_flags': discord.MemberCacheFlags.none()}
+        intents.members = False
+    search_index = SearchIndex(SEARCH_INDEX_PATH) if SEARCH_INDEX_PATH else None
+    # Reactions are handled from raw events, so the message cache can be small (or disabled with 0)
+    client = QueueManager(storage=create_storage(), search_index=search_index, command_prefix=prefix, intents=intents,
+                          shard_count=SHARD_COUNT, shard_ids=SHARD_IDS, max_messages=MAX_MESSAGES or None,
+                          **member_options)
     client.remove_command('help')  # Remove the default help command
     client.load_extension('commands')  # Load the commands defined in commands.py
-    client.run(TOKEN)
+    client.run(token)
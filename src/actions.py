@@ -0,0 +1,104 @@
+import asyncio
+from datetime import datetime, timedelta
+from sys import stderr
+from typing import Awaitable, Iterable, List, Any, Optional, Callable, Tuple
+import discord
+from discord import TextChannel, Embed, Message
+from discord.http import Route
+
+# Discord only bulk deletes messages younger than two weeks. Keep a margin for clock differences and slow requests.
+BULK_DELETE_MAX_AGE = timedelta(days=14) - timedelta(minutes=5)
+BULK_DELETE_MAX_COUNT = 100
+
+# Discord's limits of an embed
+MAX_FIELDS = 25
+MAX_FIELD_LENGTH = 1024
+MAX_EMBED_LENGTH = 6000  # Characters in the title, description, field names and values, footer and author name
+
+
+async def gather_isolated(*aws: Awaitable) -> List[Any]:
+    """
+    Run the given Discord calls concurrently. A call that fails does not affect the others; its error is logged and its
+    result is None. NotFound errors are not logged: the message or reaction the call was about is already gone.
+    @param aws: Awaitable: The calls to run
+    @return: List: The results of the calls, in order
+    """
+    return _isolate(await asyncio.gather(*aws, return_exceptions=True))
+
+
+def detach(*aws: Awaitable, then: Optional[Callable[..., Any]] = None) -> None:
+    """
+    Run the given Discord calls concurrently without waiting for them, e.g. from an event handler that should not keep
+    its admission slot while its calls wait for the rate limits. Errors are logged like gather_isolated does.
+    @param aws: Awaitable: The calls to run
+    @param then: Optional[Callable]: Called with the results of the calls, in order, once they are all done
+    @return:
+    """
+    def done(gathered: asyncio.Future) -> None:
+        if gathered.cancelled():
+            return
+        results = _isolate(gathered.result())
+        if then is not None:
+            then(*results)
+
+    asyncio.gather(*aws, return_exceptions=True).add_done_callback(done)
+
+
+def _isolate(results: List[Any]) -> List[Any]:
+    for result in results:
+        if isinstance(result, Exception) and not isinstance(result, discord.NotFound):
+            print(f"Discord call failed: {result!r}", file=stderr)
+    return [None if isinstance(result, Exception) else result for result in results]
+
+
+async def delete_messages(channel: TextChannel, message_ids: Iterable[int]) -> None:
+    """
+    Delete messages from a channel with as few requests as possible: recent messages are deleted in bulk, up to 100 at
+    a time, older messages are deleted one by one, concurrently.
+    @param channel: discord.TextChannel: The channel the messages are in
+    @param message_ids: Iterable[int]: The messages to delete
+    @return:
+    """
+    message_ids = list(message_ids)
+    min_bulk_id = discord.utils.time_snowflake(datetime.utcnow() - BULK_DELETE_MAX_AGE)
+    recent = [discord.Object(m_id) for m_id in message_ids if m_id >= min_bulk_id]
+    old = [m_id for m_id in message_ids if m_id < min_bulk_id]
+    calls = [channel.delete_messages(recent[i:i + BULK_DELETE_MAX_COUNT])
+             for i in range(0, len(recent), BULK_DELETE_MAX_COUNT)]
+    calls += [channel.get_partial_message(m_id).delete() for m_id in old]
+    await gather_isolated(*calls)
+
+
+async def send_embeds(channel: TextChannel, embeds: List[Embed]) -> Message:
+    """
+    Send several embeds in one message. discord.py can only send one embed per message, so this calls the API directly.
+    @param channel: discord.TextChannel: The channel to send the message in
+    @param embeds: List[discord.Embed]: The embeds, up to 10
+    @return: discord.Message: The message that was sent
+    """
+    if len(embeds) == 1:
+        return await channel.send(embed=embeds[0])
+    state = channel._state
+    data = await state.http.request(Route('POST', '/channels/{channel_id}/messages', channel_id=channel.id),
+                                    json={'embeds': [embed.to_dict() for embed in embeds]})
+    return state.create_message(channel=channel, data=data)
+
+
+def add_fields(embed: Embed, fields: Iterable[Tuple[str, str]]) -> List[Embed]:
+    """
+    Add fields to an embed within Discord's limits. Values that are too long are split over several fields, and fields
+    that don't fit in the embed are added to as many embeds of the same colour after it as needed.
+    @param embed: discord.Embed: The embed to add the fields to
+    @param fields: Iterable[Tuple[str, str]]: The names and values of the fields
+    @return: List[discord.Embed]: The embed and the embeds that were added after it
+    """
+    embeds = [embed]
+    for name, value in fields:
+        # Fields can't be empty, e.g. for a message with only an attachment
+        parts = [value[i:i + MAX_FIELD_LENGTH] for i in range(0, len(value), MAX_FIELD_LENGTH)] or ['\u200b']
+        for part in parts:
+            if len(embed.fields) >= MAX_FIELDS or len(embed) + len(name) + len(part) > MAX_EMBED_LENGTH:
+                embed = Embed(colour=embed.colour)
+                embeds.append(embed)
+            embed.add_field(name=name, value=part, inline=False)
+    return embeds
@@ -0,0 +1,144 @@
+import asyncio
+import functools
+import time
+from sys import stderr
+from typing import Dict, Callable, Any, Optional
+
+import metrics
+
+REJECTED = metrics.Counter('queuemanager_events_rejected_total', "Events shed because their server's queue was full",
+                           ['handler'])
+
+
+class _Gate:
+    """
+    Admission state of one server.
+    """
+
+    def __init__(self, concurrency: int):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.waiting = 0  # Events waiting for a slot
+        self.running = 0  # Events being handled
+        self.latency = 0.0  # Moving average of the seconds from receiving an event until it was handled
+        self.degraded = False
+
+
+class Admission:
+    """
+    Admission control for the events of each server. At most `concurrency` events of a server are handled at the same
+    time; others wait in line, and events that may be dropped are dropped when they arrive while `max_depth` events are
+    waiting. A server is degraded, so work that is not essential is skipped, when handling its events takes longer than
+    `degrade_latency` seconds on average, when its outbound requests need that long to be sent, or when half of
+    `max_depth` events are waiting, so before any are dropped. It recovers when all of these are back under half.
+    """
+
+    def __init__(self, concurrency: int = 8, max_depth: int = 100, degrade_latency: float = 2.0,
+                 smoothing: float = 0.1, backlog: Optional[Callable[[int], float]] = None):
+        self.concurrency = concurrency
+        self.max_depth = max_depth
+        self.degrade_latency = degrade_latency
+        self.smoothing = smoothing  # Weight of the latest event in the moving average
+        self.backlog = backlog  # Gets the seconds until the requests waiting for a server are sent
+        self.gates: Dict[int, _Gate] = {}  # Kept while the server is idle, so its latency isn't forgotten
+
+    def __len__(self) -> int:
+        return sum(gate.waiting for gate in self.gates.values())
+
+    def degraded(self, guild_id: int) -> bool:
+        """
+        @param guild_id: int: The server
+        @return: bool: Whether non-essential work should be skipped for this server
+        """
+        return (gate := self.gates.get(guild_id)) is not None and gate.degraded
+
+    async def enter(self, guild_id: int, droppable: bool = True) -> bool:
+        """
+        Wait for a slot to handle an event of a server.
+        @param guild_id: int: The server
+        @param droppable: bool: Whether the event may be dropped; events that can't be dropped always wait in line
+        @return: bool: Whether the event may be handled; False if too many events are waiting already
+        """
+        try:
+            gate = self.gates[guild_id]
+        except KeyError:
+            gate = self.gates[guild_id] = _Gate(self.concurrency)
+        if gate.waiting >= self.max_depth // 2:
+            self._update(guild_id, gate)
+        if droppable and gate.waiting >= self.max_depth:
+            return False
+        gate.waiting += 1
+        try:
+            await gate.semaphore.acquire()
+        finally:
+            gate.waiting -= 1
+        gate.running += 1
+        return True
+
+    def leave(self, guild_id: int, latency: float) -> None:
+        """
+        Free the slot of a handled event and update the latency of the server.
+        @param guild_id: int: The server
+        @param latency: float: Seconds from receiving the event until it was handled
+        @return:
+        """
+        gate = self.gates[guild_id]
+        gate.semaphore.release()
+        gate.running -= 1
+        gate.latency += self.smoothing * (latency - gate.latency)
+        self._update(guild_id, gate)
+
+    def forget(self, guild_id: int) -> None:
+        """
+        Forget the state of a server the bot left, unless some of its events are still being handled.
+        @param guild_id: int: The server
+        @return:
+        """
+        if (gate := self.gates.get(guild_id)) is not None and not gate.running and not gate.waiting:
+            del self.gates[guild_id]
+
+    def _update(self, guild_id: int, gate: _Gate) -> None:
+        """
+        Degrade or recover a server, depending on its latency, outbound backlog and waiting events.
+        """
+        backlog = self.backlog(guild_id) if self.backlog is not None else 0.0
+        if not gate.degraded and (max(gate.latency, backlog) > self.degrade_latency
+                                  or gate.waiting >= self.max_depth // 2):
+            gate.degraded = True
+            print(f"Server {guild_id} is overloaded ({self._load(gate, backlog)}), skipping non-essential work",
+                  file=stderr)
+        elif gate.degraded and max(gate.latency, backlog) < self.degrade_latency / 2 \
+                and gate.waiting < self.max_depth // 4:
+            gate.degraded = False
+            print(f"Server {guild_id} recovered ({self._load(gate, backlog)})", file=stderr)
+
+    @staticmethod
+    def _load(gate: _Gate, backlog: float) -> str:
+        return f"{gate.latency:.2f} s per event, {backlog:.1f} s of outbound requests, {gate.waiting} events waiting"
+
+
+def admitted(guild_of: Callable[[Any], Optional[int]], droppable: bool = True):
+    """
+    Decorator for event handlers of the bot that passes their events through its admission control. Events outside of
+    servers are handled right away. Dropped events are still passed to the handler, with `shed=True` and without
+    waiting for a slot, so it can keep its bookkeeping up to date while it skips requests to Discord.
+    @param guild_of: Callable: Gets the ID of the server from the event, or None
+    @param droppable: bool: Whether events may be dropped when too many are waiting, rather than wait in line
+    """
+
+    def decorator(handler):
+        name = handler.__name__
+
+        @functools.wraps(handler)
+        async def wrapper(self, event):
+            if (guild_id := guild_of(event)) is None:
+                return await handler(self, event)
+            start = time.perf_counter()
+            if not await self.admission.enter(guild_id, droppable):
+                REJECTED.inc(name)
+                return await handler(self, event, shed=True)
+            try:
+                return await handler(self, event)
+            finally:
+                self.admission.leave(guild_id, time.perf_counter() - start)
+        return wrapper
+    return decorator
@@ -0,0 +1,140 @@
+import asyncio
+from sys import stderr
+from typing import Dict, Optional, Iterable
+
+from config import CLAIM_FLUSH_INTERVAL
+from storage import Storage, Claim
+
+
+class ClaimTable:
+    """
+    The owners of claimed messages. The table in memory is the source of truth; changes are written to the storage in
+    batches every few moments (write-behind) and when the bot shuts down, and loaded again when it starts.
+    """
+
+    def __init__(self, storage: Storage, flush_interval: float = CLAIM_FLUSH_INTERVAL):
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self.owners: Dict[int, Claim] = {}  # Message ID -> IDs of the manager that claimed it, the server and channel
+        self.per_channel: Dict[int, int] = {}  # Channel ID -> number of claimed messages in it
+        self._pending: Dict[int, Optional[Claim]] = {}  # Changes not yet written to the storage; None means removed
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()  # Serializes writes to the storage
+
+    @property
+    def pending(self) -> int:
+        """
+        @return: int: The number of changes not yet written to the storage
+        """
+        return len(self._pending)
+
+    def _add(self, message_id: int, claim: Claim) -> None:
+        self.owners[message_id] = claim
+        self.per_channel[claim[2]] = self.per_channel.get(claim[2], 0) + 1
+
+    def _remove(self, message_id: int) -> Optional[Claim]:
+        if (claim := self.owners.pop(message_id, None)) is not None:
+            if (count := self.per_channel[claim[2]] - 1) > 0:
+                self.per_channel[claim[2]] = count
+            else:
+                del self.per_channel[claim[2]]
+        return claim
+
+    def claim(self, message_id: int, owner_id: int, server_id: int, channel_id: int) -> bool:
+        """
+        Set the owner of a message, unless the message is already claimed.
+        @param message_id: int: The claimed message
+        @param owner_id: int: The manager that claimed the message
+        @param server_id: int: The server the message is in
+        @param channel_id: int: The channel the message is in
+        @return: bool: Whether the message was claimed by this call
+        """
+        if message_id in self.owners:
+            return False
+        self._add(message_id, (owner_id, server_id, channel_id))
+        self._pending[message_id] = self.owners[message_id]
+        return True
+
+    def get_owner(self, message_id: int) -> Optional[int]:
+        """
+        Get the manager that claimed a message.
+        @param message_id: int: The message
+        @return: Optional[int]: ID of the manager, or None if the message is not claimed
+        """
+        claim = self.owners.get(message_id)
+        return claim[0] if claim is not None else None
+
+    def in_channel(self, channel_id: int) -> Dict[int, int]:
+        """
+        Get the claimed messages in a channel.
+        @param channel_id: int: The channel
+        @return: Dict[int, int]: Maps message IDs to the ID of their owner
+        """
+        return {m: owner_id for m, (owner_id, _, c) in self.owners.items() if c == channel_id}
+
+    def count(self, channel_id: int) -> int:
+        """
+        @param channel_id: int: The channel
+        @return: int: The number of claimed messages in the channel
+        """
+        return self.per_channel.get(channel_id, 0)
+
+    def unclaim(self, message_id: int) -> None:
+        """
+        Forget the owner of a message.
+        @param message_id: int: The message
+        @return:
+        """
+        if self._remove(message_id) is not None:
+            self._pending[message_id] = None
+
+    async def load(self, server_ids: Iterable[int]) -> None:
+        """
+        Load the claimed messages of some servers from the storage, e.g. those of a previous session. Claims made in
+        this session take precedence.
+        @param server_ids: Iterable[int]: The servers
+        @return:
+        """
+        for message_id, claim in (await self.storage.get_claims(server_ids)).items():
+            if message_id not in self._pending and message_id not in self.owners:  # Not changed in the meantime
+                self._add(message_id, claim)
+
+    async def flush(self) -> None:
+        """
+        Write all pending changes to the storage in one batch. Changes that fail to be written are retried on the next
+        flush.
+        @return:
+        """
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            try:
+                await self.storage.write_claims(batch)
+            except Exception as e:
+                print(f"Could not persist claimed messages: {e}", file=stderr)
+                batch.update(self._pending)  # Changes made while writing are newer
+                self._pending = batch
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self) -> None:
+        """
+        Start writing changes to the storage periodically. Does nothing if already started.
+        @return:
+        """
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._flush_periodically())
+
+    async def close(self) -> None:
+        """
+        Stop writing periodically and write the remaining changes.
+        @return:
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
@@ -0,0 +1,134 @@
+"""
+Run the bot as a cluster of processes, each owning a contiguous range of the shards. The processes share the MySQL
+or SQLite storage; everything else (server configurations, claims, message indexes, member cache) is local to the
+process that owns the server.
+
+Usage:
+    python cluster.py --processes 4 [--shards 16]
+"""
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+from sys import stderr
+from typing import List, Optional, Dict
+
+from discord.http import HTTPClient
+
+from config import config, STORAGE, METRICS_PORT, METRICS_FILE, RELEASE
+
+IDENTIFY_INTERVAL = 5  # Discord allows one shard to connect every 5 seconds
+RESTART_DELAY = 10  # Seconds to wait before restarting a process that stopped
+
+
+async def recommended_shards(token: str) -> int:
+    """
+    Ask Discord how many shards the bot should use.
+    @param token: str: The bot token
+    @return: int: The recommended number of shards
+    """
+    http = HTTPClient()
+    try:
+        await http.static_login(token.strip(), bot=True)
+        shard_count, _ = await http.get_bot_gateway()
+        return shard_count
+    finally:
+        await http.close()
+
+
+def shard_ranges(shard_count: int, processes: int) -> List[range]:
+    """
+    Divide the shards over the processes as evenly as possible.
+    @param shard_count: int: The total number of shards
+    @param processes: int: The number of processes
+    @return: List[range]: The shards of each process
+    """
+    size, remainder = divmod(shard_count, processes)
+    ranges, start = [], 0
+    for i in range(processes):
+        end = start + size + (i < remainder)
+        ranges.append(range(start, end))
+        start = end
+    return [r for r in ranges if r]
+
+
+class Worker:
+    """
+    A bot process that runs a range of shards.
+    """
+
+    def __init__(self, index: int, shards: range, shard_count: int):
+        self.index = index
+        self.shards = shards
+        self.env = {**os.environ,
+                    'QUEUEMANAGER_SHARD_COUNT': str(shard_count),
+                    'QUEUEMANAGER_SHARD_IDS': f"{shards.start}-{shards.stop - 1}"}
+        # Every process serves or writes its own metrics
+        if METRICS_PORT is not None:
+            self.env['QUEUEMANAGER_METRICS_PORT'] = str(METRICS_PORT + index)
+        if METRICS_FILE is not None:
+            self.env['QUEUEMANAGER_METRICS_FILE'] = f"{METRICS_FILE}.{index}"
+        self.process: Optional[subprocess.Popen] = None
+
+    def start(self) -> None:
+        print(f"Starting process {self.index} with shards {self.shards.start}-{self.shards.stop - 1}", file=stderr)
+        self.process = subprocess.Popen([sys.executable, 'QueueManager.py'], env=self.env,
+                                        cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def stop(self) -> None:
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help="Number of bot processes")
+    parser.add_argument('--shards', type=int, default=None,
+                        help="Total number of shards (default: the number recommended by Discord)")
+    args = parser.parse_args()
+    if STORAGE == 'memory':
+        parser.error("The processes of a cluster need a shared storage, use QUEUEMANAGER_STORAGE=mysql or sqlite")
+
+    token, _ = config(release=RELEASE)
+    shard_count = args.shards or asyncio.get_event_loop().run_until_complete(recommended_shards(token))
+    workers = [Worker(i, shards, shard_count) for i, shards in enumerate(shard_ranges(shard_count, args.processes))]
+
+    stopping = False
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+        for w in workers:
+            w.stop()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    # Start the processes one after the other, so their shards don't all try to connect at the same time.
+    for worker in workers:
+        if stopping:
+            break
+        worker.start()
+        time.sleep(IDENTIFY_INTERVAL * len(worker.shards))
+
+    stopped_at: Dict[int, float] = {}
+    while not stopping:  # Restart processes that stopped unexpectedly
+        time.sleep(1)
+        for worker in workers:
+            if worker.process.poll() is None:
+                continue
+            stopped_at.setdefault(worker.index, time.monotonic())
+            if time.monotonic() - stopped_at[worker.index] >= RESTART_DELAY:
+                print(f"Process {worker.index} stopped with exit code {worker.process.returncode}", file=stderr)
+                del stopped_at[worker.index]
+                worker.start()
+    for worker in workers:
+        if worker.process is not None:
+            worker.process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,39 @@
 import re
-from typing import List, Set
-from lazy_streams import stream
+from typing import List, Set, TYPE_CHECKING
 from discord import Embed, TextChannel, Role
 from discord.ext import commands
 from discord.ext.commands import Context
 
-from QueueManager import QueueManager
-from config import PREFIX
+import rules
 from server_conf import ServerConfiguration
-from database_connection import execute_query
+
+if TYPE_CHECKING:  # Only for the annotations, the bot module is loaded already when it loads this extension
+    from QueueManager import QueueManager
+
+
+def _duration(seconds: float) -> str:
+    """
+    Format a duration for people, e.g. '1h 5m' or '42s'.
+    @param seconds: float: The duration
+    @return: str: The formatted duration
+    """
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h {minutes}m"
+    if minutes:
+        return f"{minutes}m {seconds}s"
+    return f"{seconds}s"
 
 
 class CommandsCog(commands.Cog):
-    def __init__(self, client: QueueManager):
+    def __init__(self, client: 'QueueManager'):
         self.client = client
 
+    @property
+    def prefix(self) -> str:
+        return self.client.command_prefix
+
     @commands.command(name='archive', aliases=[' archive'])
     @commands.has_permissions(administrator=True)
     @commands.guild_only()
@@ -24,12 +43,7 @@ class CommandsCog(commands.Cog):
         @param context: discord.ext.commands.Context: The context of the command
         @return:
         """
-        channel_id = str(context.channel.id)
-        server_id = str(context.guild.id)
-        execute_query("INSERT INTO servers "
-                      "(serverid, archiveid) VALUES (%s, %s) "
-                      "ON DUPLICATE KEY UPDATE  archiveid = VALUES(archiveid)",
-                      (server_id, channel_id))
+        await self.client.storage.set_archive(context.guild.id, context.channel.id)
         self.client.get_server_conf(context.guild).set_archive(context.channel)
         embed = Embed(title="Archive channel", colour=0xffe400)
         embed.add_field(name="Success!", value=f"{context.channel.mention} is now set as the archive channel.")
@@ -47,7 +61,7 @@ class CommandsCog(commands.Cog):
         content = context.message.content
         if len(content.split()[1:]) == 0:
             await context.send(f"Tag the channels to enable as queue channel the in command's arguments: "
-                               f"`{PREFIX}questions #questions1 #questions2`.")
+                               f"`{self.prefix}questions #questions1 #questions2`.")
             return
         channel_ids: List[str] = re.findall(r'<#(\d+)>', content)  # Find all channel IDs in the message
         queues: Set[TextChannel] = set()
@@ -57,14 +71,9 @@ class CommandsCog(commands.Cog):
                 queues.add(queue)
         if len(queues) == 0:
             await context.send(f"Tag the channels to enable as queue channel the in command's arguments: "
-                               f"`{PREFIX}questions #questions1 #questions2`.")
+                               f"`{self.prefix}questions #questions1 #questions2`.")
             return
-        queue_ids_string = " ".join(stream(list(queues)).map(lambda c: c.id).map(str).to_list())
-        server_id = str(context.guild.id)
-        execute_query("INSERT INTO servers "
-                      "(serverid, queues) VALUES (%s, %s) "
-                      "ON DUPLICATE KEY UPDATE  queues = VALUES(queues)",
-                      (server_id, queue_ids_string))
+        await self.client.storage.set_queues(context.guild.id, {q.id for q in queues})
         self.client.get_server_conf(context.guild).set_queues(queues)
         embed = Embed(title="Queue channels", colour=0xffe400)
         embed.add_field(name="Success!", value=f"The channel(s) used as queues are: "
@@ -83,7 +92,7 @@ class CommandsCog(commands.Cog):
         content = context.message.content
         if len(content.split()[1:]) == 0:  # No arguments
             await context.send(f"Tag the roles to be allowed to manage queues in the command's arguments: "
-                               f"`{PREFIX}roles @Role1 @Role2`.")
+                               f"`{self.prefix}roles @Role1 @Role2`.")
             return
         role_ids: List[str] = re.findall(r'<@&(\d+)>', content)  # Clear the tagging syntax around roles IDs
         roles: Set[Role] = set()
@@ -93,14 +102,9 @@ class CommandsCog(commands.Cog):
                 roles.add(role)
         if len(roles) == 0:
             await context.send(f"Tag the roles to be allowed to manage queues in the command's arguments: "
-                               f"`{PREFIX}roles @Role1 @Role2`.")
+                               f"`{self.prefix}roles @Role1 @Role2`.")
             return
-        role_ids_string = " ".join(stream(list(roles)).map(lambda r: r.id).map(str).to_list())
-        server_id = str(context.guild.id)
-        execute_query("INSERT INTO servers "
-                      "(serverid, roles) VALUES (%s, %s) "
-                      "ON DUPLICATE KEY UPDATE  roles = VALUES(roles)",
-                      (server_id, role_ids_string))
+        await self.client.storage.set_roles(context.guild.id, {r.id for r in roles})
         self.client.get_server_conf(context.guild).set_roles(roles)
         embed = Embed(title="Queue manager roles", colour=0xffe400)
         embed.add_field(name="Success!", value=f"The role(s) that can manage queues are: "
@@ -122,7 +126,7 @@ class CommandsCog(commands.Cog):
         try:
             archive = configuration.archive.mention  # Raises AttributeError if None.
         except AttributeError:
-            archive = f"Not yet defined. Use the `{PREFIX}archive` command in the channel you want to set as " \
+            archive = f"Not yet defined. Use the `{self.prefix}archive` command in the channel you want to set as " \
                       f"archive channel"
         embed.add_field(name="Archive channel:", value=archive, inline=False)
 
@@ -133,7 +137,7 @@ class CommandsCog(commands.Cog):
                 queues.add(q.mention)
             except AttributeError:
                 pass
-        msg = ", ".join(queues) or f"None defined. Use the `{PREFIX}queues` command to declare channels as queues."
+        msg = ", ".join(queues) or f"None defined. Use the `{self.prefix}queues` command to declare channels as queues."
         embed.add_field(name="Queue channels:", value=msg, inline=False)
 
         # Manager roles
@@ -143,10 +147,59 @@ class CommandsCog(commands.Cog):
                 roles.add(r.mention)
             except AttributeError:
                 pass
-        msg = ", ".join(roles) or f"None defined. Use the `{PREFIX}roles` command to declare roles as managers."
+        msg = ", ".join(roles) or f"None defined. Use the `{self.prefix}roles` command to declare roles as managers."
         embed.add_field(name="Queue Manager roles:", value=msg, inline=False)
         await context.send(embed=embed)
 
+    @commands.command(name='rules', aliases=['rule'])
+    @commands.has_permissions(administrator=True)
+    @commands.guild_only()
+    async def configure_rules(self, context: Context):
+        """
+        Show or change the rules that classify new questions: `rules`, `rules add <action> <pattern>`,
+        `rules remove <number>` or `rules reset`.
+        @param context: discord.ext.commands.Context: The context of the command
+        @return:
+        """
+        configuration: ServerConfiguration = self.client.get_server_conf(context.guild)
+        current = list(configuration.rules if configuration.rules is not None else rules.DEFAULT_RULES)
+        arguments = context.message.content.split(maxsplit=3)[1:]
+        usage = f"Use `{self.prefix}rules add <{'|'.join(rules.ACTIONS)}> <pattern>`, `{self.prefix}rules remove " \
+                f"<number>` or `{self.prefix}rules reset`."
+        try:
+            if not arguments:  # Show the rules
+                new = None
+            elif arguments[0] == 'add' and len(arguments) == 3:
+                if len(current) >= rules.MAX_RULES:
+                    raise ValueError(f"A server can have at most {rules.MAX_RULES} rules.")
+                new = current + [rules.validate(arguments[1].lower(), arguments[2])]
+            elif arguments[0] == 'remove' and len(arguments) == 2 and arguments[1].isdigit() and \
+                    1 <= int(arguments[1]) <= len(current):
+                new = current[:int(arguments[1]) - 1] + current[int(arguments[1]):]
+            elif arguments[0] == 'reset' and len(arguments) == 1:
+                new = rules.DEFAULT_RULES
+            else:
+                raise ValueError(usage)
+        except ValueError as e:
+            await context.send(str(e))
+            return
+        if new is not None:
+            new = None if new == rules.DEFAULT_RULES else new
+            await self.client.storage.set_rules(context.guild.id, new)
+            configuration.set_rules(new)
+            current = new if new is not None else rules.DEFAULT_RULES
+        embed = Embed(title="Question rules", colour=0xffe400,
+                      description="New questions are checked against these rules in order, and the first one that "
+                                  "matches decides: `ack` questions get a :thumbsup: instead of being claimed, "
+                                  "`archive` questions are archived as soon as they are claimed, and `ignore` "
+                                  "messages are not treated as questions. A pattern is one or more phrases separated "
+                                  "by `|` and matches messages that contain one of them; in a phrase, `#` stands for a "
+                                  "number and a space for any whitespace. A pattern that starts with `<N` only matches "
+                                  "messages shorter than N characters. " + usage)
+        for number, (action, pattern) in enumerate(current, start=1):
+            embed.add_field(name=f"{number}. {action}", value=f"`{pattern}`", inline=False)
+        await context.send(embed=embed)
+
     @commands.command(name='reset')
     @commands.has_permissions(administrator=True)
     @commands.guild_only()
@@ -156,16 +209,65 @@ class CommandsCog(commands.Cog):
         @param context: discord.ext.commands.Context: The context of the command
         @return:
         """
-        execute_query("DELETE FROM servers WHERE serverid = %s",
-                      (str(context.guild.id),))
-        try:
-            del self.client.server_confs[context.guild]  # Delete server configuration
-        except KeyError:
-            pass
+        await self.client.storage.delete_server(context.guild.id)
+        self.client.server_confs[context.guild.id] = ServerConfiguration(context.guild)  # Start from an empty one
         embed = Embed(title="Server configuration reset", colour=0xffe400)
         embed.add_field(name="Reset succesful", value="All configurations for this server are removed.")
         await context.send(embed=embed)
 
+    @commands.command(name='search', aliases=['find'])
+    @commands.guild_only()
+    async def search_archive(self, context: Context):
+        """
+        Search the archived questions of this server for the words given in the arguments of this command. Only for
+        members that can read the archive channel, queue managers and administrators.
+        @param context: discord.ext.commands.Context: The context of the command
+        @return:
+        """
+        archive = self.client.get_server_conf(context.guild).archive
+        if not (context.author.guild_permissions.administrator or self.client.is_manager(context.author)
+                or (archive is not None and archive.permissions_for(context.author).read_messages)):
+            return
+        if self.client.search_index is None:
+            await context.send("Searching the archive is not enabled.")
+            return
+        terms = context.message.content.split(maxsplit=1)[1:]
+        if not terms:  # No arguments
+            await context.send(f"Give the words to search for in the command's arguments: `{self.prefix}search words`.")
+            return
+        results = await self.client.search_index.search(context.guild.id, terms[0])
+        embed = Embed(title="Archive search", colour=0xffe400)
+        for result in results:
+            embed.add_field(name=f"{result.author} in #{result.channel}, {result.created_at:%Y-%m-%d}",
+                            value=f"{result.snippet[:900]}\n[Jump to the archive]({result.url})", inline=False)
+        if not results:
+            embed.description = "No archived questions contain these words."
+        await context.send(embed=embed)
+
+    @commands.command(name='stats', aliases=['statistics'])
+    @commands.guild_only()
+    async def show_statistics(self, context: Context):
+        """
+        Show the number of waiting and claimed questions in the queues of this server, and how long questions waited
+        to be claimed and archived since the bot started. Only for queue managers and administrators.
+        @param context: discord.ext.commands.Context: The context of the command
+        @return:
+        """
+        if not (context.author.guild_permissions.administrator or self.client.is_manager(context.author)):
+            return
+        embed = Embed(title="Queue statistics", colour=0xffe400)
+        for queue in self.client.get_queue_channels(context.guild):
+            stats = self.client.stats.channel(queue.id)
+            lines = [f"Waiting: {stats.waiting}, claimed: {self.client.claims.count(queue.id)}"]
+            for name, sketch in (("claim", stats.time_to_claim), ("archive", stats.time_to_archive)):
+                if sketch.count:
+                    lines.append(f"Time to {name}: median {_duration(sketch.quantile(0.5))}, "
+                                 f"90% within {_duration(sketch.quantile(0.9))} ({sketch.count} questions)")
+            embed.add_field(name=f"#{queue}", value='\n'.join(lines), inline=False)
+        if not embed.fields:
+            embed.description = f"None defined. Use the `{self.prefix}queues` command to declare channels as queues."
+        await context.send(embed=embed)
+
     @commands.command(name='help')
     async def help_command(self, context: Context):
         """
@@ -173,6 +275,7 @@ class CommandsCog(commands.Cog):
         @param context: discord.ext.commands.Context: The context of the command
         @return:
         """
+        prefix = self.prefix
         # Allow use by server admins and in DMs
         if context.guild is not None:
             if not context.message.author.guild_permissions.administrator:
@@ -189,15 +292,18 @@ class CommandsCog(commands.Cog):
                               "and the roles that can manage queues. See below on how to declare these.",
                         inline=False)
         embed.add_field(name="Command usage",
-                        value=f"`{PREFIX}help` → Show this menu.\n"
-                              f"`{PREFIX}archive` → Use this command in the channel you want to use as archive.\n"
-                              f"`{PREFIX}queues #channels` → Declare channels as queues. You can "
-                              f"tag one or multiple channels: `{PREFIX}queue #channel` / `{PREFIX}queues #channel1 "
+                        value=f"`{prefix}help` → Show this menu.\n"
+                              f"`{prefix}archive` → Use this command in the channel you want to use as archive.\n"
+                              f"`{prefix}queues #channels` → Declare channels as queues. You can "
+                              f"tag one or multiple channels: `{prefix}queue #channel` / `{prefix}queues #channel1 "
                               f"#channel2 ...`\n"
-                              f"`{PREFIX}roles` → Declare roles as queue managers. You can tag one or multiple roles:\n"
-                              f"`{PREFIX}role @Role` / `{PREFIX}roles @Role1 @Role2 ...`\n"
-                              f"`{PREFIX}config` → Show the current Queue Manager configurations for this server.\n"
-                              f"`{PREFIX}reset` → Clear all configurations for this server.")
+                              f"`{prefix}roles` → Declare roles as queue managers. You can tag one or multiple roles:\n"
+                              f"`{prefix}role @Role` / `{prefix}roles @Role1 @Role2 ...`\n"
+                              f"`{prefix}config` → Show the current Queue Manager configurations for this server.\n"
+                              f"`{prefix}search words` → Find archived questions that contain these words.\n"
+                              f"`{prefix}stats` → Show the waiting times and the number of waiting questions.\n"
+                              f"`{prefix}rules` → Show or change the rules that classify new questions.\n"
+                              f"`{prefix}reset` → Clear all configurations for this server.")
         embed.add_field(name="Queue management",
                         value="When a regular user sends a message in a queue channel, the bot wil reply with "
                               ":inbox_tray:. Consecutive messages by the same user (ignoring interruptions by "
@@ -210,5 +316,5 @@ class CommandsCog(commands.Cog):
         await context.send(embed=embed)
 
 
-def setup(client: QueueManager):
+def setup(client: 'QueueManager'):
     client.add_cog(CommandsCog(client))
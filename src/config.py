@@ -1,13 +1,103 @@
-from typing import Tuple
+import os
+from typing import Tuple, Optional, List
 
-TOKEN = open('/etc/QueueManagerToken', 'r').read()  # Bot token issued by Discord
+# Bot token issued by Discord: QUEUEMANAGER_TOKEN, or else the contents of this file. Only read when the bot starts.
+TOKEN_PATH = os.environ.get('QUEUEMANAGER_TOKEN_PATH', '/etc/QueueManagerToken')
 PREFIX = '?'
 
-DEV_TOKEN = open('/etc/QueueManagerDevToken', 'r').read()
+DEV_TOKEN_PATH = os.environ.get('QUEUEMANAGER_DEV_TOKEN_PATH', '/etc/QueueManagerDevToken')
 DEV_PREFIX = '$'
+RELEASE = True  # Whether the release bot runs, rather than the development bot
+
+# Seconds from the start of the process until the first event is handled. A warning is printed when startup takes
+# longer; 0 disables the warning. The startup times are always part of the metrics.
+STARTUP_BUDGET = float(os.environ.get('QUEUEMANAGER_STARTUP_BUDGET', 0))
+
+# Storage backend: 'mysql', 'sqlite' (embedded database file) or 'memory' (nothing is persisted)
+STORAGE = os.environ.get('QUEUEMANAGER_STORAGE', 'mysql')
+SQLITE_PATH = os.environ.get('QUEUEMANAGER_SQLITE_PATH', 'queuemanager.db')
+CLAIM_FLUSH_INTERVAL = float(os.environ.get('QUEUEMANAGER_CLAIM_FLUSH_INTERVAL', 1))  # Seconds between claim writes
+
+# MySQL connection settings. Can be overridden with environment variables.
+DB_USER = os.environ.get('QUEUEMANAGER_DB_USER', 'thijs')
+DB_HOST = os.environ.get('QUEUEMANAGER_DB_HOST', 'localhost')
+DB_NAME = os.environ.get('QUEUEMANAGER_DB_NAME', 'queuemanager')
+DB_POOL_SIZE = int(os.environ.get('QUEUEMANAGER_DB_POOL_SIZE', 5))  # Number of warm connections (and worker threads)
+DB_TIMEOUT = float(os.environ.get('QUEUEMANAGER_DB_TIMEOUT', 10))  # Seconds before a query is given up on
+DB_RETRIES = int(os.environ.get('QUEUEMANAGER_DB_RETRIES', 2))  # Retries after a failed connection attempt
+# Number of messages kept in discord.py's message cache. Reactions are handled without it; 0 disables the cache.
+MAX_MESSAGES = int(os.environ.get('QUEUEMANAGER_MAX_MESSAGES', 100))
+
+# Seconds an archived question waits to be posted together with others in one message (up to 10 per message), which
+# raises the number of questions that can be archived per second. 0 posts every question on its own.
+ARCHIVE_BATCH_WINDOW = float(os.environ.get('QUEUEMANAGER_ARCHIVE_BATCH_WINDOW', 0))
+
+# Claims are kept across restarts. At startup the latest RECONCILE_LIMIT messages of every queue channel with claimed
+# messages are read, RECONCILE_CONCURRENCY channels at a time, to forget claims of deleted messages and restore the
+# reactions of claimed ones.
+RECONCILE_LIMIT = int(os.environ.get('QUEUEMANAGER_RECONCILE_LIMIT', 200))
+RECONCILE_CONCURRENCY = int(os.environ.get('QUEUEMANAGER_RECONCILE_CONCURRENCY', 4))
+
+# Admission control. At most ADMISSION_CONCURRENCY messages and reactions of a server are handled at the same time and
+# at most ADMISSION_QUEUE messages wait for their turn; more are only recorded, without requests to Discord other than
+# a low priority reaction to new questions, while reactions always wait. While handling them takes longer than
+# DEGRADE_LATENCY seconds on average, sending the waiting requests would take that long, or half of ADMISSION_QUEUE
+# messages are waiting, transient replies and confirmation timeouts are skipped and chain detection doesn't wait for
+# requests.
+ADMISSION_CONCURRENCY = int(os.environ.get('QUEUEMANAGER_ADMISSION_CONCURRENCY', 8))
+ADMISSION_QUEUE = int(os.environ.get('QUEUEMANAGER_ADMISSION_QUEUE', 100))
+DEGRADE_LATENCY = float(os.environ.get('QUEUEMANAGER_DEGRADE_LATENCY', 2.0))
+
+# Archived questions are also written to a full-text index in this SQLite file, to be found with the search command.
+# An empty value disables the index.
+SEARCH_INDEX_PATH = os.environ.get('QUEUEMANAGER_SEARCH_INDEX_PATH', 'search.db')
+
+# Members. In 'lean' mode the bot does not use the privileged members intent and does not download all members of
+# every server at startup; it only keeps the members it deals with, for MEMBER_TTL seconds, and requests others when
+# needed. In 'full' mode all members are cached and role changes are received as they happen.
+MEMBER_CACHE = os.environ.get('QUEUEMANAGER_MEMBER_CACHE', 'lean')
+MEMBER_CACHE_SIZE = int(os.environ.get('QUEUEMANAGER_MEMBER_CACHE_SIZE', 10000))
+MEMBER_TTL = float(os.environ.get('QUEUEMANAGER_MEMBER_TTL', 600))
+
+# Metrics in the Prometheus text format, served on http://METRICS_HOST:METRICS_PORT/metrics and/or written to
+# METRICS_FILE every METRICS_INTERVAL seconds. Disabled unless a port or file is given.
+METRICS_PORT = int(os.environ['QUEUEMANAGER_METRICS_PORT']) if 'QUEUEMANAGER_METRICS_PORT' in os.environ else None
+METRICS_HOST = os.environ.get('QUEUEMANAGER_METRICS_HOST', '127.0.0.1')
+METRICS_FILE = os.environ.get('QUEUEMANAGER_METRICS_FILE')
+METRICS_INTERVAL = float(os.environ.get('QUEUEMANAGER_METRICS_INTERVAL', 15))
+
+# Sharding. By default the bot runs all shards Discord recommends in one process. A process of a cluster (see
+# cluster.py) runs a range of shards, e.g. QUEUEMANAGER_SHARD_IDS=4-7 with QUEUEMANAGER_SHARD_COUNT=16.
+SHARD_COUNT = int(os.environ['QUEUEMANAGER_SHARD_COUNT']) if 'QUEUEMANAGER_SHARD_COUNT' in os.environ else None
+
+
+def parse_shard_ids(value: Optional[str]) -> Optional[List[int]]:
+    """
+    Parse a list of shard IDs, e.g. '0-3' or '0,2,5-7'.
+    @param value: Optional[str]: The shard IDs
+    @return: Optional[List[int]]: The shard IDs, or None if no value is given
+    """
+    if not value:
+        return None
+    shard_ids = []
+    for part in value.split(','):
+        first, _, last = part.partition('-')
+        shard_ids.extend(range(int(first), int(last or first) + 1))
+    return shard_ids
+
+
+SHARD_IDS = parse_shard_ids(os.environ.get('QUEUEMANAGER_SHARD_IDS'))
 
 
 def config(release: bool) -> Tuple[str, str]:
-    if release:
-        return TOKEN, PREFIX
-    return DEV_TOKEN, DEV_PREFIX
+    """
+    Get the bot token and command prefix of the release or development bot. Reads only the token file of that bot, and
+    none if the token is given in QUEUEMANAGER_TOKEN.
+    @param release: bool: Whether to run the release bot
+    @return: Tuple[str, str]: The token and the prefix
+    """
+    prefix = PREFIX if release else DEV_PREFIX
+    if 'QUEUEMANAGER_TOKEN' in os.environ:
+        return os.environ['QUEUEMANAGER_TOKEN'].strip(), prefix
+    with open(TOKEN_PATH if release else DEV_TOKEN_PATH, 'r') as file:
+        return file.read().strip(), prefix
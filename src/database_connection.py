@@ -1,34 +1,128 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
 from sys import stderr
-from typing import Tuple, Optional, Union
+from typing import Tuple, Optional, Union, List
 import mysql.connector
+from mysql.connector import pooling
 
+import metrics
+from config import DB_USER, DB_HOST, DB_NAME, DB_POOL_SIZE, DB_TIMEOUT, DB_RETRIES
 
-def execute_query(query: str, data: Optional[Tuple] = None, return_result: bool = False,
-                  return_cursor_count: bool = False) -> Union[None, list, int]:
+# Queries run on a dedicated thread pool so they never block the event loop. There are exactly as many threads as
+# pooled connections, so a thread can always get a connection from the pool.
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix='database')
+_pool: Optional[pooling.MySQLConnectionPool] = None
+
+# Errors after which the same query may succeed later. Queries that fail with these return None; other errors, like
+# those of an outdated schema, are raised.
+CONNECTION_ERRORS = (mysql.connector.OperationalError, mysql.connector.InterfaceError, mysql.connector.PoolError,
+                     asyncio.TimeoutError)
+
+
+def _get_pool() -> pooling.MySQLConnectionPool:
+    """
+    Get the connection pool, creating it on first use.
+    @return: MySQLConnectionPool: The connection pool
+    """
+    global _pool
+    if _pool is None:
+        _pool = pooling.MySQLConnectionPool(pool_name='queuemanager', pool_size=DB_POOL_SIZE,
+                                            user=DB_USER, host=DB_HOST, database=DB_NAME,
+                                            connection_timeout=int(DB_TIMEOUT))
+    return _pool
+
+
+def _run_query(query: str, data: Union[None, Tuple, List[Tuple]], return_result: bool,
+               return_cursor_count: bool, many: bool = False) -> Union[None, list, int]:
+    """
+    Execute the given query on a pooled connection. Runs on a database thread. Connection errors are retried.
+    @return: None, list or int
+    """
+    for attempt in range(DB_RETRIES + 1):
+        try:
+            connection = _get_pool().get_connection()
+        except mysql.connector.Error:
+            if attempt == DB_RETRIES:
+                raise
+            time.sleep(0.1 * 2 ** attempt)  # Back off before trying to connect again
+            continue
+        try:
+            cursor = connection.cursor(buffered=True)
+            if many:  # Execute the query once for every tuple in data, in a single transaction
+                cursor.executemany(query, data)
+            elif data is not None:
+                cursor.execute(query, data)
+            else:
+                cursor.execute(query)
+            result = None
+            if return_result:
+                result = cursor.fetchall()
+            elif return_cursor_count:
+                result = cursor.rowcount
+            connection.commit()  # Commit whatever happened in func to the database.
+            cursor.close()
+            return result
+        except (mysql.connector.OperationalError, mysql.connector.InterfaceError):
+            if attempt == DB_RETRIES:  # Lost the connection, retry on a fresh one
+                raise
+        finally:
+            connection.close()  # Return the connection to the pool
+
+
+async def execute_query_async(query: str, data: Optional[Tuple] = None, return_result: bool = False,
+                              return_cursor_count: bool = False) -> Union[None, list, int]:
     """
-    Execute the given query on the database.
+    Execute the given query on the database without blocking the event loop.
     @param query: str: The query to execute
     @param data: Optional[Tuple] the data to include in the query
     @param return_result: bool: Whether or not to return the results from the query
     @param return_cursor_count: Whether or not to return the number of rows affected in the database
     @return: None, list or int
     """
-    try:  # Connect to database.
-        connection = mysql.connector.connect(user='thijs', host='localhost', database='queuemanager')
-        cursor = connection.cursor(buffered=True)
-        if data is not None:
-            cursor.execute(query, data)
-        else:
-            cursor.execute(query)
-        result = None
-        if return_result:
-            result = cursor.fetchall()
-        elif return_cursor_count:
-            result = cursor.rowcount
-        connection.commit()  # Commit whatever happened in func to the database.
-        cursor.close()
-        connection.disconnect()
+    loop = asyncio.get_event_loop()
+    start = time.perf_counter()
+    try:
+        result = await asyncio.wait_for(loop.run_in_executor(_executor, _run_query, query, data, return_result,
+                                                             return_cursor_count),
+                                        timeout=DB_TIMEOUT)
+        metrics.observe_query(query, time.perf_counter() - start)
         return result
-    except mysql.connector.Error:
-        print("Database connection error", file=stderr)
+    except CONNECTION_ERRORS as e:
+        metrics.observe_query(query, time.perf_counter() - start, failed=True)
+        print(f"Database connection error: {e!r}", file=stderr)
         return
+    except mysql.connector.Error:  # E.g. a column that is missing because the schema was not upgraded
+        metrics.observe_query(query, time.perf_counter() - start, failed=True)
+        raise
+
+
+async def execute_many_async(query: str, data: List[Tuple]) -> Optional[int]:
+    """
+    Execute the given query for every tuple in data, in a single transaction, without blocking the event loop.
+    @param query: str: The query to execute
+    @param data: List[Tuple]: The data to include in each execution of the query
+    @return: Optional[int]: The number of rows affected, or None if the database could not be reached
+    """
+    loop = asyncio.get_event_loop()
+    start = time.perf_counter()
+    try:
+        result = await asyncio.wait_for(loop.run_in_executor(_executor, _run_query, query, data, False, True, True),
+                                        timeout=DB_TIMEOUT)
+        metrics.observe_query(query, time.perf_counter() - start)
+        return result
+    except CONNECTION_ERRORS as e:
+        metrics.observe_query(query, time.perf_counter() - start, failed=True)
+        print(f"Database connection error: {e!r}", file=stderr)
+        return
+    except mysql.connector.Error:  # E.g. a column that is missing because the schema was not upgraded
+        metrics.observe_query(query, time.perf_counter() - start, failed=True)
+        raise
+
+
+def close() -> None:
+    """
+    Wait for running queries to finish and stop the database threads.
+    @return:
+    """
+    _executor.shutdown(wait=True)
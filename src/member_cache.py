@@ -0,0 +1,89 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+import discord
+from discord import Guild, Member
+
+Key = Tuple[int, int]  # server_id, member_id
+
+
+class MemberCache:
+    """
+    Least recently used cache of the members the bot actually deals with: authors of messages in queues, members that
+    react, and the managers they interact with. Members expire after a while, as their roles may have changed without
+    the bot being told. Members that are not cached are requested from Discord only when needed.
+    """
+
+    def __init__(self, size: int = 10000, ttl: float = 600):
+        self.size = size
+        self.ttl = ttl
+        self.members: Dict[Key, Tuple[float, Member]] = OrderedDict()  # Key -> (expiry time, member)
+        self._fetches: Dict[Key, asyncio.Task] = {}  # Requests for members that are in progress
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    def add(self, member: Member) -> None:
+        """
+        Remember a member, e.g. the author of a message. Members in events are up to date, so this resets their expiry.
+        @param member: discord.Member: The member
+        @return:
+        """
+        key = (member.guild.id, member.id)
+        self.members[key] = (time.monotonic() + self.ttl, member)
+        self.members.move_to_end(key)
+        if len(self.members) > self.size:
+            self.members.popitem(last=False)  # Forget the least recently used member
+
+    def get(self, guild: Guild, member_id: int) -> Optional[Member]:
+        """
+        Get a member without a request: from this cache, or from discord.py's member cache.
+        @param guild: discord.Guild: The server of the member
+        @param member_id: int: The member
+        @return: Optional[discord.Member]: The member, or None if it is not cached
+        """
+        key = (guild.id, member_id)
+        try:
+            expires, member = self.members[key]
+        except KeyError:
+            return guild.get_member(member_id)
+        if expires < time.monotonic():
+            del self.members[key]
+            return guild.get_member(member_id)
+        self.members.move_to_end(key)
+        return member
+
+    async def _fetch(self, guild: Guild, member_id: int) -> Optional[Member]:
+        try:
+            member = await guild.fetch_member(member_id)
+        except discord.NotFound:  # The member left the server
+            return None
+        self.add(member)
+        return member
+
+    async def fetch(self, guild: Guild, member_id: int) -> Optional[Member]:
+        """
+        Get a member, and request it from Discord if it is not cached. Concurrent calls for the same member share one
+        request.
+        @param guild: discord.Guild: The server of the member
+        @param member_id: int: The member
+        @return: Optional[discord.Member]: The member, or None if it is not in the server
+        """
+        if (member := self.get(guild, member_id)) is not None:
+            return member
+        key = (guild.id, member_id)
+        task = self._fetches.get(key)
+        if task is None:
+            task = self._fetches[key] = asyncio.get_event_loop().create_task(self._fetch(guild, member_id))
+            task.add_done_callback(lambda _: self._fetches.pop(key, None))
+        return await asyncio.shield(task)
+
+    def remove(self, guild_id: int, member_id: int) -> None:
+        """
+        Forget a member, e.g. because they left the server.
+        @param guild_id: int: The server of the member
+        @param member_id: int: The member
+        @return:
+        """
+        self.members.pop((guild_id, member_id), None)
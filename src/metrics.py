@@ -0,0 +1,278 @@
+import asyncio
+import functools
+import logging
+import os
+import time
+from sys import stderr
+from typing import Dict, Tuple, Callable, Sequence, List, Optional
+
+from config import METRICS_PORT, METRICS_HOST, METRICS_FILE, METRICS_INTERVAL, STARTUP_BUDGET
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(names, escaped)) + '}'
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        _registry[name] = self
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return '\n'.join([f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}",
+                          *self.samples()])
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels, lv)} {v}" for lv, v in self.values.items()]
+
+
+class Gauge(Metric):
+    """
+    A value that is read when the metrics are rendered, e.g. the length of a queue.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def samples(self) -> List[str]:
+        return [f"{self.name} {self.callback()}"]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self.values: Dict[Tuple[str, ...], List[float]] = {}  # Label values -> bucket counts, then count and sum
+
+    def observe(self, value: float, *label_values: str) -> None:
+        try:
+            counts = self.values[label_values]
+        except KeyError:
+            counts = self.values[label_values] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        counts[-2] += 1
+        counts[-1] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        for lv, counts in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels + ('le',), lv + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels + ('le',), lv + ('+Inf',))} {counts[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, lv)} {counts[-2]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, lv)} {counts[-1]}")
+        return lines
+
+
+class StartupTimes(Metric):
+    """
+    Seconds from the start of the process until each phase of the startup was reached.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation, ['phase'])
+        self.phases: Dict[str, float] = {}
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels, (phase,))} {v}" for phase, v in self.phases.items()]
+
+
+def _process_start() -> float:
+    """
+    Get the time at which this process started, as reported by Linux. Elsewhere, the time this module was imported.
+    @return: float: Seconds since the epoch
+    """
+    try:
+        with open('/proc/self/stat') as file:
+            start_ticks = int(file.read().rsplit(')', 1)[1].split()[19])  # Ticks after boot, field 22
+        with open('/proc/uptime') as file:
+            uptime = float(file.read().split()[0])
+        return time.time() - uptime + start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.time()
+
+
+_registry: Dict[str, Metric] = {}
+_process_started_at = _process_start()
+
+HANDLER_LATENCY = Histogram('queuemanager_handler_seconds', "Time spent handling an event", ['handler'])
+HANDLER_ERRORS = Counter('queuemanager_handler_errors_total', "Events whose handler raised an exception", ['handler'])
+QUERY_LATENCY = Histogram('queuemanager_db_query_seconds', "Time spent on a database query", ['operation'])
+QUERY_ERRORS = Counter('queuemanager_db_query_errors_total', "Database queries that failed", ['operation'])
+REST_LATENCY = Histogram('queuemanager_discord_request_seconds', "Time spent on a Discord REST request",
+                         ['method', 'route'])
+REST_ERRORS = Counter('queuemanager_discord_request_errors_total', "Discord REST requests that failed",
+                      ['method', 'route', 'status'])
+STARTUP = StartupTimes('queuemanager_startup_seconds', "Seconds from the start of the process until a startup phase")
+RATE_LIMITS = Counter('queuemanager_discord_rate_limits_total', "Discord REST requests that were rate limited (429)",
+                      ['route'])
+
+
+def render() -> str:
+    """
+    Render all metrics in the Prometheus text format.
+    @return: str: The metrics
+    """
+    return '\n'.join(metric.render() for metric in _registry.values()) + '\n'
+
+
+def startup_phase(phase: str) -> None:
+    """
+    Record that a phase of the startup was reached, e.g. 'ready' or 'first_event'. Only the first time counts.
+    """
+    if phase in STARTUP.phases:
+        return
+    elapsed = STARTUP.phases[phase] = time.time() - _process_started_at
+    print(f"Startup: {phase} after {elapsed:.2f} s", file=stderr)
+    if phase == 'first_event' and 0 < STARTUP_BUDGET < elapsed:
+        print(f"Startup took longer than its budget of {STARTUP_BUDGET:.2f} s", file=stderr)
+
+
+def timed_handler(handler):
+    """
+    Decorator for event handlers that records their latency and errors.
+    """
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - start, name)
+    return wrapper
+
+
+def query_operation(query: str) -> str:
+    """
+    Get the label for a query: the statement and the table, e.g. 'select servers'.
+    """
+    words = query.split()
+    if not words:
+        return ''
+    tables = (word.strip(';(') for prev, word in zip(words, words[1:]) if prev.upper() in ('FROM', 'INTO', 'UPDATE'))
+    return f"{words[0].lower()} {next(tables, '')}".strip()
+
+
+def observe_query(query: str, seconds: float, failed: bool = False) -> None:
+    operation = query_operation(query)
+    QUERY_LATENCY.observe(seconds, operation)
+    if failed:
+        QUERY_ERRORS.inc(operation)
+
+
+def instrument_http(http) -> None:
+    """
+    Record the latency and errors of all REST requests made by a discord.py HTTPClient, per route.
+    @param http: discord.http.HTTPClient: The HTTP client of the bot
+    @return:
+    """
+    request = http.request
+
+    async def instrumented_request(route, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await request(route, **kwargs)
+        except Exception as e:
+            REST_ERRORS.inc(route.method, route.path, str(getattr(e, 'status', type(e).__name__)))
+            raise
+        finally:
+            REST_LATENCY.observe(time.perf_counter() - start, route.method, route.path)
+
+    http.request = instrumented_request
+
+
+class _RateLimitHandler(logging.Handler):
+    """
+    discord.py handles 429 responses itself and only logs them; count them from the log.
+    """
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if record.msg.startswith('We are being rate limited') and len(record.args) >= 2:
+            bucket = str(record.args[1])  # channel_id:guild_id:path
+            RATE_LIMITS.inc(bucket.split(':', 2)[-1])
+
+
+logging.getLogger('discord.http').addHandler(_RateLimitHandler(logging.WARNING))
+
+
+async def _serve(host: str, port: int) -> None:
+    from aiohttp import web  # Installed with discord.py
+
+    async def metrics_page(_):
+        return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_page)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+
+async def _dump_periodically(path: str, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            with open(f"{path}.tmp", 'w') as file:
+                file.write(render())
+            os.replace(f"{path}.tmp", path)  # Readers never see a partially written file
+        except OSError as e:
+            print(f"Could not write metrics: {e}", file=stderr)
+
+
+_started = False
+_dump_task: Optional[asyncio.Task] = None
+
+
+async def start() -> None:
+    """
+    Expose the metrics as configured: on a local HTTP endpoint (QUEUEMANAGER_METRICS_PORT) and/or by periodically
+    writing them to a file (QUEUEMANAGER_METRICS_FILE). Does nothing if neither is configured or already started.
+    @return:
+    """
+    global _started, _dump_task
+    if _started:
+        return
+    _started = True
+    if METRICS_PORT is not None:
+        await _serve(METRICS_HOST, METRICS_PORT)
+    if METRICS_FILE is not None:
+        _dump_task = asyncio.get_event_loop().create_task(_dump_periodically(METRICS_FILE, METRICS_INTERVAL))
@@ -0,0 +1,365 @@
+import asyncio
+import functools
+import heapq
+import itertools
+from typing import Dict, List, Optional, Tuple, Callable, Awaitable, Union, Iterable, Any
+import discord
+from discord import TextChannel, Message, PartialMessage, Member, User, Embed
+
+from actions import delete_messages, send_embeds
+
+# Priorities of outbound actions, most urgent first
+HIGH = 0  # Direct responses to a user, like the acknowledgement of a claim
+NORMAL = 1
+LOW = 2  # Housekeeping, like deleting notices after a while
+
+# Discord's rate limits per channel, as (requests, seconds). Requests are spaced out to stay within these limits,
+# rather than sent all at once and retried after Discord responds with 429 Too Many Requests.
+RATE_LIMITS: Dict[str, Tuple[int, float]] = {
+    'reaction': (1, 0.25),  # Adding and removing reactions
+    'message': (5, 5.0),  # Sending messages
+    'delete': (5, 5.0),  # Deleting messages, one by one or in bulk
+}
+
+# Discord's limits on the embeds of one message
+MAX_EMBEDS = 10
+MAX_EMBEDS_LENGTH = 6000  # Characters in all titles, descriptions, field names and values, footers and author names
+
+Key = Tuple  # Identifies what an operation does, e.g. ('add_reaction', message_id, emoji)
+
+
+def _conflicts(a: Key, b: Key) -> bool:
+    """
+    @return: bool: Whether the order of two operations on the same message matters, e.g. adding and removing the same
+    reaction
+    """
+    if a[0] in ('delete', 'clear_reactions') or b[0] in ('delete', 'clear_reactions'):
+        return True
+    return a[2] == b[2]  # Changes to the same reaction
+
+
+class TokenBucket:
+    """
+    Allows `capacity` requests per `per` seconds, and bursts of up to `capacity` requests.
+    """
+
+    def __init__(self, capacity: int, per: float):
+        self.capacity = capacity
+        self.rate = capacity / per
+        self.tokens = float(capacity)
+        self.updated = asyncio.get_event_loop().time()
+
+    def refill(self) -> None:
+        now = asyncio.get_event_loop().time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        """
+        Wait until a request can be made within the limit.
+        @return:
+        """
+        self.refill()
+        if self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+            self.refill()
+        self.tokens -= 1
+
+
+class _Operation:
+    __slots__ = ('lane', 'message_id', 'key', 'call', 'priority', 'seq', 'future', 'cancelled', 'submitted')
+
+    def __init__(self, lane: '_Lane', message_id: Optional[int], key: Key, call: Callable[[], Awaitable],
+                 priority: int, seq: int):
+        self.lane = lane
+        self.message_id = message_id
+        self.key = key
+        self.call = call  # Creates the coroutine only when the operation is executed
+        self.priority = priority
+        self.seq = seq
+        self.future = asyncio.get_event_loop().create_future()
+        self.cancelled = False
+        self.submitted = asyncio.get_event_loop().time()
+
+
+class _Lane:
+    """
+    The operations of a channel that share a rate limit, executed by priority, then in the order they were submitted.
+    """
+
+    def __init__(self, pipeline: 'ChannelPipeline', name: str, serial: bool):
+        self.pipeline = pipeline
+        self.name = name
+        self.serial = serial  # Wait for each operation to finish before the next one, e.g. to keep reactions in order
+        limit = pipeline.outbound.limits.get(name)
+        self.bucket = TokenBucket(*limit) if limit is not None else None
+        self.heap: List[Tuple[int, int, _Operation]] = []  # Also holds outdated entries of promoted or cancelled ones
+        self.waiting = 0  # Operations that are waiting to be executed
+        self.task: Optional[asyncio.Task] = None
+        self.running: List[asyncio.Task] = []
+        self.embeds: Optional[asyncio.Task] = None  # The latest embeds, sent after the ones before them
+
+    def push(self, op: _Operation) -> None:
+        heapq.heappush(self.heap, (op.priority, op.seq, op))
+        self.waiting += 1
+        if self.task is None:
+            self.task = asyncio.get_event_loop().create_task(self._run())
+
+    def promote(self, op: _Operation, priority: int) -> None:
+        """
+        Give a waiting operation a higher priority. Its old entry stays in the heap and is skipped.
+        """
+        op.priority = priority
+        heapq.heappush(self.heap, (op.priority, op.seq, op))
+
+    def backlog(self) -> float:
+        """
+        @return: float: Estimated seconds until the operations that are waiting are executed, given the rate limit
+        """
+        if self.bucket is None or not self.waiting:
+            return 0.0
+        self.bucket.refill()
+        requests = 1 if self.name == 'delete' else self.waiting  # Deletes are combined
+        return max(0.0, requests - self.bucket.tokens) / self.bucket.rate
+
+    def _peek(self) -> Optional[_Operation]:
+        while self.heap:
+            priority, _, op = self.heap[0]
+            if not op.cancelled and not op.future.done() and op.priority == priority:
+                return op
+            heapq.heappop(self.heap)  # Skip outdated entries
+        return None
+
+    def _pop(self) -> Optional[_Operation]:
+        if (op := self._peek()) is not None:
+            heapq.heappop(self.heap)
+            self.waiting -= 1
+        return op
+
+    async def _embed_batch(self, first: _Operation) -> List[_Operation]:
+        """
+        Wait for the batch window of the first embed to pass, then take the embeds that are waiting after it, as many as
+        fit in one message.
+        @param first: _Operation: The first embed to send
+        @return: List[_Operation]: The embeds to send in one message, in order
+        """
+        if (wait := first.submitted + self.pipeline.outbound.embed_window - asyncio.get_event_loop().time()) > 0:
+            await asyncio.sleep(wait)
+        ops, length = [first], len(first.key[1])
+        while len(ops) < MAX_EMBEDS and (op := self._peek()) is not None and op.key[0] == 'embed' \
+                and length + len(op.key[1]) <= MAX_EMBEDS_LENGTH:
+            ops.append(self._pop())
+            length += len(op.key[1])
+        return ops
+
+    async def _run(self) -> None:
+        try:
+            while self.heap:
+                if self.bucket is not None:
+                    await self.bucket.acquire()
+                if (op := self._pop()) is None:
+                    break
+                ops = [op]
+                if self.name == 'delete':  # Delete all messages that are waiting at once
+                    while (other := self._pop()) is not None:
+                        ops.append(other)
+                    call = functools.partial(delete_messages, self.pipeline.channel, [o.message_id for o in ops])
+                elif op.key[0] == 'embed' and self.pipeline.outbound.embed_window > 0:
+                    ops = await self._embed_batch(op)
+                    call = functools.partial(send_embeds, self.pipeline.channel, [o.key[1] for o in ops])
+                else:
+                    call = op.call
+                for o in ops:
+                    self.pipeline.forget(o)
+                if self.serial:
+                    await self._execute(ops, call)
+                else:
+                    # Embeds are chained, so the archive keeps the order in which questions were archived
+                    after = self.embeds if op.key[0] == 'embed' else None
+                    task = asyncio.get_event_loop().create_task(self._execute(ops, call, after))
+                    if op.key[0] == 'embed':
+                        self.embeds = task
+                    self.running.append(task)
+                    task.add_done_callback(self.running.remove)
+        finally:
+            self.task = None
+
+    @staticmethod
+    async def _execute(ops: List[_Operation], call: Callable[[], Awaitable],
+                       after: Optional[asyncio.Task] = None) -> None:
+        if after is not None and not after.done():
+            await asyncio.wait([after])
+        try:
+            result = await call()
+        except Exception as e:
+            for op in ops:
+                if not op.future.done():
+                    op.future.set_exception(e)
+        else:
+            for op in ops:
+                if not op.future.done():
+                    op.future.set_result(result)
+
+    async def drain(self) -> None:
+        while self.task is not None or self.running:
+            await asyncio.gather(*filter(None, [self.task]), *self.running, return_exceptions=True)
+
+
+class ChannelPipeline:
+    """
+    The outbound operations of one channel. Operations on the same message are combined where possible: an operation
+    that is already waiting is not submitted twice unless a conflicting operation was submitted after it, clearing a
+    reaction drops the waiting additions and removals of that reaction, and deleting a message drops all waiting
+    reaction changes on it.
+    """
+
+    def __init__(self, outbound: 'Outbound', channel: TextChannel):
+        self.outbound = outbound
+        self.channel = channel
+        self.lanes = {name: _Lane(self, name, serial=name == 'reaction') for name in ('reaction', 'message', 'delete')}
+        self.pending: Dict[int, List[_Operation]] = {}  # Message ID -> operations on it that are waiting
+
+    def _cancel(self, message_id: int, matches: Callable[[Key], bool]) -> None:
+        for op in [op for op in self.pending.get(message_id, ()) if matches(op.key)]:
+            op.cancelled = True
+            op.future.set_result(None)
+            op.lane.waiting -= 1
+            self.forget(op)
+
+    def forget(self, op: _Operation) -> None:
+        if op.message_id is None or (ops := self.pending.get(op.message_id)) is None:
+            return
+        if op in ops:
+            ops.remove(op)
+        if not ops:
+            del self.pending[op.message_id]
+
+    def submit(self, lane: str, message_id: Optional[int], key: Key, call: Callable[[], Awaitable],
+               priority: int) -> asyncio.Future:
+        """
+        Submit an operation.
+        @param lane: str: The rate limit the operation falls under: 'reaction', 'message' or 'delete'
+        @param message_id: Optional[int]: The message the operation is about, to combine it with others on the message
+        @param key: Key: What the operation does
+        @param call: Callable[[], Awaitable]: Performs the operation
+        @param priority: int: HIGH, NORMAL or LOW
+        @return: asyncio.Future: The result of the operation, or None if it turned out to be unnecessary
+        """
+        if message_id is not None:
+            waiting = self.pending.get(message_id, [])
+            # Operations on the same message keep their order: promote the ones that are waiting to this priority
+            for op in waiting:
+                if op.priority > priority:
+                    op.lane.promote(op, priority)
+            for op in reversed(waiting):
+                if op.key == key:
+                    return op.future  # Already waiting, and nothing after it undoes it
+                if _conflicts(op.key, key):
+                    break
+            action = key[0]
+            if action in ('delete', 'clear_reactions'):
+                self._cancel(message_id, lambda k: k[0] in ('add_reaction', 'remove_reaction', 'clear_reaction'))
+            elif action == 'clear_reaction':
+                self._cancel(message_id, lambda k: k[0] in ('add_reaction', 'remove_reaction') and k[2] == key[2])
+        op = _Operation(self.lanes[lane], message_id, key, call, priority, next(self.outbound.counter))
+        if message_id is not None:
+            self.pending.setdefault(message_id, []).append(op)
+        op.lane.push(op)
+        return op.future
+
+    async def drain(self) -> None:
+        await asyncio.gather(*(lane.drain() for lane in self.lanes.values()))
+
+
+class Outbound:
+    """
+    Sends the Discord REST requests of the bot that change messages in channels, through a pipeline per channel that
+    combines redundant operations, executes urgent operations first, and stays within the rate limits of the channel.
+    Every method returns a future with the result of the request.
+    """
+
+    def __init__(self, limits: Optional[Dict[str, Tuple[int, float]]] = None, embed_window: float = 0):
+        self.limits = RATE_LIMITS if limits is None else limits  # Lanes without a limit are not throttled
+        # Seconds an embed sent with send_embed waits for others to be sent in the same message. 0 disables batching.
+        self.embed_window = embed_window
+        self.pipelines: Dict[int, ChannelPipeline] = {}  # Channel ID -> pipeline
+        self.servers: Dict[int, List[ChannelPipeline]] = {}  # Server ID -> pipelines of its channels
+        self.counter = itertools.count()
+
+    def __len__(self) -> int:
+        return sum(lane.waiting for pipeline in self.pipelines.values() for lane in pipeline.lanes.values())
+
+    def pipeline(self, channel: TextChannel) -> ChannelPipeline:
+        try:
+            return self.pipelines[channel.id]
+        except KeyError:
+            pipeline = self.pipelines[channel.id] = ChannelPipeline(self, channel)
+            if (guild := getattr(channel, 'guild', None)) is not None:
+                self.servers.setdefault(guild.id, []).append(pipeline)
+            return pipeline
+
+    def backlog(self, guild_id: int) -> float:
+        """
+        @param guild_id: int: The server
+        @return: float: Estimated seconds until the operations that are waiting in the channels of the server are
+        executed
+        """
+        return max((lane.backlog() for pipeline in self.servers.get(guild_id, ()) for lane in pipeline.lanes.values()),
+                   default=0.0)
+
+    def add_reaction(self, message: Union[Message, PartialMessage], emoji: str,
+                     priority: int = NORMAL) -> asyncio.Future:
+        return self.pipeline(message.channel).submit('reaction', message.id, ('add_reaction', message.id, emoji),
+                                                     lambda: message.add_reaction(emoji), priority)
+
+    def add_reactions(self, message: Union[Message, PartialMessage], emojis: Iterable[str],
+                      priority: int = NORMAL) -> Awaitable[List[Any]]:
+        """
+        Add reactions to a message in the given order.
+        """
+        return asyncio.gather(*(self.add_reaction(message, emoji, priority) for emoji in emojis))
+
+    def remove_reaction(self, message: Union[Message, PartialMessage], emoji: Union[str, discord.PartialEmoji],
+                        member: Union[Member, User], priority: int = NORMAL) -> asyncio.Future:
+        return self.pipeline(message.channel).submit('reaction', message.id,
+                                                     ('remove_reaction', message.id, str(emoji), member.id),
+                                                     lambda: message.remove_reaction(emoji, member), priority)
+
+    def clear_reaction(self, message: Union[Message, PartialMessage], emoji: str,
+                       priority: int = NORMAL) -> asyncio.Future:
+        return self.pipeline(message.channel).submit('reaction', message.id, ('clear_reaction', message.id, emoji),
+                                                     lambda: message.clear_reaction(emoji), priority)
+
+    def clear_reactions(self, message: Union[Message, PartialMessage], priority: int = NORMAL) -> asyncio.Future:
+        return self.pipeline(message.channel).submit('reaction', message.id, ('clear_reactions', message.id),
+                                                     message.clear_reactions, priority)
+
+    def delete(self, channel: TextChannel, message_id: int, priority: int = NORMAL) -> asyncio.Future:
+        """
+        Delete a message. Messages of the same channel that are waiting to be deleted are deleted in bulk.
+        """
+        return self.pipeline(channel).submit('delete', message_id, ('delete', message_id), None, priority)
+
+    def reply(self, message: Union[Message, PartialMessage], content: str, priority: int = NORMAL) -> asyncio.Future:
+        return self.pipeline(message.channel).submit('message', None, ('reply', message.id),
+                                                     lambda: message.reply(content), priority)
+
+    def send(self, channel: TextChannel, content: Optional[str] = None, embed: Optional[Embed] = None,
+             priority: int = NORMAL) -> asyncio.Future:
+        return self.pipeline(channel).submit('message', None, ('send',),
+                                             lambda: channel.send(content, embed=embed), priority)
+
+    def send_embed(self, channel: TextChannel, embed: Embed, priority: int = NORMAL) -> asyncio.Future:
+        """
+        Send an embed. If batching is enabled, embeds sent to the same channel within the batch window are sent in one
+        message, in the order they were submitted, up to Discord's limits of a message.
+        """
+        return self.pipeline(channel).submit('message', None, ('embed', embed),
+                                             lambda: channel.send(embed=embed), priority)
+
+    async def close(self) -> None:
+        """
+        Wait until all submitted operations are done.
+        @return:
+        """
+        await asyncio.gather(*(pipeline.drain() for pipeline in self.pipelines.values()))
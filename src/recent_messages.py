@@ -0,0 +1,97 @@
+import asyncio
+from collections import deque
+from typing import Deque, Dict, Iterator, Tuple, Collection, Callable, Optional
+from discord import TextChannel, Member
+
+Entry = Tuple[int, int]  # message_id, author_id
+
+
+class RecentMessages:
+    """
+    Bounded log of the most recent messages in each queue channel, to find out who posted last without requesting the
+    channel history from Discord.
+    """
+
+    def __init__(self, size: int = 15, on_author: Optional[Callable[[Member], None]] = None):
+        self.size = size
+        self.on_author = on_author  # Called with the authors of the messages requested from Discord
+        self.channels: Dict[int, Deque[Entry]] = {}  # Channel ID -> recent messages, oldest first
+        self._backfills: Dict[int, asyncio.Task] = {}  # Channel ID -> request for the latest messages of the channel
+
+    def add(self, channel_id: int, message_id: int, author_id: int) -> None:
+        """
+        Add a message that was sent in a channel.
+        @param channel_id: int: The channel the message was sent in
+        @param message_id: int: The message
+        @param author_id: int: The author of the message
+        @return:
+        """
+        log = self.channels.setdefault(channel_id, deque(maxlen=self.size))
+        if not log or log[-1][0] < message_id:  # Messages almost always arrive in order
+            log.append((message_id, author_id))
+        else:
+            self._merge(channel_id, [(message_id, author_id)])
+
+    def remove(self, channel_id: int, message_id: int) -> None:
+        """
+        Remove a message that was deleted.
+        @param channel_id: int: The channel the message was in
+        @param message_id: int: The deleted message
+        @return:
+        """
+        log = self.channels.get(channel_id)
+        if log is None:
+            return
+        for entry in log:
+            if entry[0] == message_id:
+                log.remove(entry)
+                return
+
+    def recent(self, channel_id: int) -> Iterator[Entry]:
+        """
+        Iterate over the recent messages in a channel, newest first.
+        @param channel_id: int: The channel
+        @return: Iterator[Entry]: (message_id, author_id) tuples
+        """
+        return reversed(self.channels.get(channel_id, ()))
+
+    def _merge(self, channel_id: int, entries) -> None:
+        log = self.channels.get(channel_id, ())
+        merged = dict(entries)
+        merged.update(log)
+        # Message IDs are snowflakes, so sorting on them orders the messages by the time they were sent.
+        self.channels[channel_id] = deque(sorted(merged.items())[-self.size:], maxlen=self.size)
+
+    async def _backfill(self, channel: TextChannel) -> None:
+        entries = []
+        async for m in channel.history(limit=self.size):
+            entries.append((m.id, m.author.id))
+            if self.on_author is not None and isinstance(m.author, Member):
+                self.on_author(m.author)
+        self._merge(channel.id, entries)
+
+    async def backfill(self, channel: TextChannel) -> None:
+        """
+        Fill the log of a channel with its latest messages. These are requested from Discord only once per channel;
+        later calls wait for that request to finish.
+        @param channel: discord.TextChannel: The channel
+        @return:
+        """
+        task = self._backfills.get(channel.id)
+        if task is None:
+            task = self._backfills[channel.id] = asyncio.get_event_loop().create_task(self._backfill(channel))
+        try:
+            await asyncio.shield(task)
+        except Exception:
+            self._backfills.pop(channel.id, None)  # Try again next time
+            raise
+
+    def forget_channels(self, channel_ids: Collection[int]) -> None:
+        """
+        Forget the messages of some channels, e.g. those of a shard that reconnected.
+        @param channel_ids: Collection[int]: The channels
+        @return:
+        """
+        for channel_id in channel_ids:
+            self.channels.pop(channel_id, None)
+            self._backfills.pop(channel_id, None)
@@ -0,0 +1,80 @@
+import asyncio
+from sys import stderr
+from typing import Iterable, Optional, Set
+from discord import TextChannel, Message
+
+from actions import gather_isolated
+from claims import ClaimTable
+from outbound import Outbound, LOW
+
+
+class Reconciler:
+    """
+    Brings the claims loaded from the storage in line with the queue channels after the bot (re)connects. Each channel
+    is read once, up to a number of messages, several channels at a time. Claims of messages that were deleted while
+    the bot was offline are forgotten, and claimed messages get their 📤 and ❌ reactions back if they are missing.
+    """
+
+    def __init__(self, claims: ClaimTable, outbound: Outbound, limit: int = 200, concurrency: int = 4):
+        self.claims = claims
+        self.outbound = outbound
+        self.limit = limit  # Messages to read per channel
+        self.semaphore = asyncio.Semaphore(concurrency)  # Channels to read at the same time
+        self.running: Set[asyncio.Task] = set()
+
+    def start(self, channels: Iterable[TextChannel]) -> None:
+        """
+        Reconcile the given channels in the background. Channels that only have unclaimed messages are skipped.
+        @param channels: Iterable[discord.TextChannel]: The queue channels
+        @return:
+        """
+        for channel in channels:
+            if self.claims.count(channel.id):
+                task = asyncio.get_event_loop().create_task(self._reconcile(channel))
+                self.running.add(task)
+                task.add_done_callback(self.running.discard)
+
+    async def wait(self) -> None:
+        """
+        Wait until all channels that are being reconciled are done.
+        @return:
+        """
+        await asyncio.gather(*self.running, return_exceptions=True)
+
+    async def _reconcile(self, channel: TextChannel) -> None:
+        async with self.semaphore:
+            try:
+                await self.reconcile(channel)
+            except Exception as e:
+                print(f"Could not reconcile the claims in #{channel}: {e!r}", file=stderr)
+
+    async def reconcile(self, channel: TextChannel) -> None:
+        """
+        Reconcile the claims of one channel with its latest messages.
+        @param channel: discord.TextChannel: The queue channel
+        @return:
+        """
+        oldest: Optional[int] = None
+        read = 0
+        seen: Set[int] = set()
+        calls = []
+        async for message in channel.history(limit=self.limit):  # Newest first
+            oldest = message.id
+            read += 1
+            seen.add(message.id)
+            if self.claims.get_owner(message.id) is not None:
+                calls += self._restore_reactions(message)
+        claimed = self.claims.in_channel(channel.id)
+        complete = read < self.limit  # Read the whole channel, so claimed messages that were not seen are gone
+        for message_id in claimed:
+            if message_id not in seen and (complete or (oldest is not None and message_id > oldest)):
+                self.claims.unclaim(message_id)
+        await gather_isolated(*calls)
+
+    def _restore_reactions(self, message: Message) -> list:
+        mine = {str(reaction.emoji) for reaction in message.reactions if reaction.me}
+        calls = []
+        if '📥' in mine:
+            calls.append(self.outbound.clear_reaction(message, '📥', LOW))
+        calls += [self.outbound.add_reaction(message, emoji, LOW) for emoji in ('📤', '❌') if emoji not in mine]
+        return calls
@@ -0,0 +1,105 @@
+import json
+import re
+from typing import List, Tuple, Optional
+
+Rule = Tuple[str, str]  # action, pattern
+
+# What happens to a new question that matches a rule:
+ACK = 'ack'  # When it is claimed, it gets a 👍 and is removed from the queue without archiving it
+ARCHIVE = 'archive'  # When it is claimed, it is archived right away
+IGNORE = 'ignore'  # It is not treated as a question
+ACTIONS = (ACK, ARCHIVE, IGNORE)
+
+# A pattern is one or more phrases separated by |, and matches messages that contain one of them. In a phrase, # stands
+# for a number and a space for any amount of whitespace, including none. A pattern that starts with <N only matches
+# messages shorter than N characters. Patterns are not regular expressions given by administrators, so matching a
+# message takes time linear in its length, whatever the rules of a server are.
+NUMBER = '#'
+SHORTER = re.compile(r'<(\d+)\s+')
+
+# Short requests to join a voice channel, e.g. "vc 3". Used by servers that did not configure rules.
+DEFAULT_RULES: List[Rule] = [(ACK, '<60 voice #|vc #|channel #|chat #|v #|inactivacti #')]
+MAX_RULES = 20
+MAX_PATTERN_LENGTH = 200
+MAX_CONTENT_LENGTH = 2000  # Characters of a message that are classified, as long as Discord allows messages to be
+
+
+def _parse(pattern: str) -> Tuple[Optional[int], List[str]]:
+    """
+    @param pattern: str: A pattern
+    @return: Tuple[Optional[int], List[str]]: The length messages must be shorter than, or None, and the phrases
+    """
+    shorter = None
+    if (match := SHORTER.match(pattern)) is not None:
+        shorter, pattern = int(match.group(1)), pattern[match.end():]
+    phrases = [' '.join(phrase.split()) for phrase in pattern.split('|')]
+    return shorter, [phrase for phrase in phrases if phrase]
+
+
+def _translate(pattern: str) -> str:
+    """
+    Translate a pattern into an equivalent regular expression that only uses literal text, single digits and runs of
+    whitespace. A number is matched by its first digit, which is enough to decide whether a message contains it.
+    @param pattern: str: A pattern
+    @return: str: The regular expression
+    """
+    shorter, phrases = _parse(pattern)
+    alternatives = '|'.join(r'\s*'.join(r'\d'.join(map(re.escape, word.split(NUMBER))) for word in phrase.split(' '))
+                            for phrase in phrases)
+    length = rf'(?=.{{0,{min(max(shorter, 1), MAX_CONTENT_LENGTH) - 1}}}\Z)' if shorter is not None else ''
+    return rf'{length}(?=.*?(?:{alternatives}))'
+
+
+def validate(action: str, pattern: str) -> Rule:
+    """
+    Check a rule given by a server administrator.
+    @param action: str: One of ACTIONS
+    @param pattern: str: Phrases separated by |, optionally preceded by <N
+    @return: Rule: The rule
+    @raise ValueError: With an explanation for the administrator, if the rule is not valid
+    """
+    if action not in ACTIONS:
+        raise ValueError(f"The action must be one of {', '.join(ACTIONS)}.")
+    if not pattern or len(pattern) > MAX_PATTERN_LENGTH:
+        raise ValueError(f"The pattern must be between 1 and {MAX_PATTERN_LENGTH} characters long.")
+    shorter, phrases = _parse(pattern)
+    if shorter is not None and not 1 <= shorter <= MAX_CONTENT_LENGTH:
+        raise ValueError(f"The length in `<N` must be between 1 and {MAX_CONTENT_LENGTH}.")
+    if not phrases:
+        raise ValueError("The pattern must contain at least one phrase.")
+    return action, pattern
+
+
+def dumps(rules: List[Rule]) -> str:
+    return json.dumps(rules)
+
+
+def loads(value: Optional[str]) -> Optional[List[Rule]]:
+    """
+    @param value: Optional[str]: Rules as stored, or None if the server did not configure rules
+    @return: Optional[List[Rule]]: The rules, or None
+    """
+    return [(action, pattern) for action, pattern in json.loads(value)] if value is not None else None
+
+
+class Classifier:
+    """
+    The rules of a server compiled into a single regular expression, so classifying a message is one match however
+    many rules there are. Every rule is a lookahead from the start of the message in its own named group, and the
+    alternatives are tried in order, so the first rule that matches decides.
+    """
+
+    def __init__(self, rules: List[Rule]):
+        rules = [(action, pattern) for action, pattern in rules if _parse(pattern)[1]]
+        self.actions = [action for action, _ in rules]
+        alternatives = '|'.join(f'(?P<r{i}>{_translate(pattern)})' for i, (_, pattern) in enumerate(rules))
+        self.expression = re.compile(rf'\A(?:{alternatives})', re.IGNORECASE | re.DOTALL) if rules else None
+
+    def classify(self, content: str) -> Optional[str]:
+        """
+        @param content: str: The content of a message, of which the first MAX_CONTENT_LENGTH characters are checked
+        @return: Optional[str]: The action of the first rule that matches, or None if no rule matches
+        """
+        if self.expression is None or (match := self.expression.match(content[:MAX_CONTENT_LENGTH])) is None:
+            return None
+        return self.actions[int(match.lastgroup[1:])]
@@ -0,0 +1,129 @@
+import asyncio
+import heapq
+import itertools
+import math
+from typing import List, Tuple, Optional, Union, Set
+from discord import TextChannel, Member, User, Message
+
+from actions import gather_isolated
+from outbound import Outbound, LOW
+
+# An action is ('delete', channel, message_id) or ('remove_reaction', channel, message_id, emoji, member)
+Action = Tuple
+Entry = Tuple[float, int, Action]  # due time, sequence number (keeps scheduling order for equal times), action
+
+
+class Scheduler:
+    """
+    Runs deferred Discord actions, like deleting a message after a few seconds, from a single task. Actions that are due
+    are submitted to the outbound pipelines with a low priority; messages to delete in the same channel are deleted in
+    bulk there. Handlers that schedule an action don't have to wait for it, so no coroutine or message is kept alive in
+    the meantime.
+    """
+
+    def __init__(self, outbound: Outbound, tick: float = 0.5):
+        self.outbound = outbound
+        self.tick = tick
+        self._heap: List[Entry] = []
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._running: Set[asyncio.Task] = set()  # Batches of actions being executed
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def _schedule(self, delay: float, action: Action) -> None:
+        # Round the due time up to a whole tick, so actions scheduled around the same time are executed together.
+        due = math.ceil((asyncio.get_event_loop().time() + delay) / self.tick) * self.tick
+        if not self._heap or due < self._heap[0][0]:
+            self._wakeup.set()  # The runner has to wake up earlier than it planned
+        heapq.heappush(self._heap, (due, next(self._counter), action))
+
+    def delete_later(self, channel: TextChannel, message_id: int, delay: float) -> None:
+        """
+        Delete a message after a delay.
+        @param channel: discord.TextChannel: The channel the message is in
+        @param message_id: int: The message to delete
+        @param delay: float: Seconds to wait before deleting
+        @return:
+        """
+        self._schedule(delay, ('delete', channel, message_id))
+
+    def delete_sent_later(self, message: Optional[Message], delay: float) -> None:
+        """
+        Delete a message the bot sent after a delay, if it could be sent.
+        @param message: Optional[discord.Message]: The message, or None if sending it failed
+        @param delay: float: Seconds to wait before deleting
+        @return:
+        """
+        if message is not None:
+            self.delete_later(message.channel, message.id, delay)
+
+    def remove_reaction_later(self, channel: TextChannel, message_id: int, emoji: str, member: Union[Member, User],
+                              delay: float) -> None:
+        """
+        Remove a reaction from a message after a delay. Nothing happens if the message was deleted in the meantime.
+        @param channel: discord.TextChannel: The channel the message is in
+        @param message_id: int: The message to remove the reaction from
+        @param emoji: str: The emoji of the reaction
+        @param member: discord.Member or discord.User: The member whose reaction to remove
+        @param delay: float: Seconds to wait before removing the reaction
+        @return:
+        """
+        self._schedule(delay, ('remove_reaction', channel, message_id, emoji, member))
+
+    async def _execute(self, actions: List[Action]) -> None:
+        """
+        Submit the given actions to the outbound pipelines and wait for them.
+        @param actions: List[Action]: The actions to execute
+        @return:
+        """
+        calls = []
+        for action in actions:
+            if action[0] == 'delete':
+                _, channel, message_id = action
+                calls.append(self.outbound.delete(channel, message_id, LOW))
+            else:
+                _, channel, message_id, emoji, member = action
+                calls.append(self.outbound.remove_reaction(channel.get_partial_message(message_id), emoji, member, LOW))
+        await gather_isolated(*calls)
+
+    def _pop_due(self, until: float) -> List[Action]:
+        due = []
+        while self._heap and self._heap[0][0] <= until:
+            due.append(heapq.heappop(self._heap)[2])
+        return due
+
+    async def _run(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - loop.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+                continue  # An earlier action was scheduled
+            except asyncio.TimeoutError:
+                pass
+            if actions := self._pop_due(loop.time()):
+                task = loop.create_task(self._execute(actions))  # Don't hold up the next tick
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+    def start(self) -> None:
+        """
+        Start executing actions when they are due. Does nothing if already started.
+        @return:
+        """
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    async def close(self) -> None:
+        """
+        Stop the scheduler and immediately execute all actions that are still waiting.
+        @return:
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await asyncio.gather(self._execute(self._pop_due(math.inf)), *self._running)
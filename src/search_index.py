@@ -0,0 +1,113 @@
+import asyncio
+import datetime
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional
+
+import metrics
+from config import DB_TIMEOUT
+
+
+class SearchResult(NamedTuple):
+    author: str
+    channel: str
+    created_at: datetime.datetime
+    snippet: str  # Part of the question around the matched words, which are in bold
+    url: str  # Jump link to the archived question
+
+
+def _match_expression(server_id: int, terms: str) -> str:
+    """
+    Turn the words of a search into an FTS5 query that matches the questions of a server containing all of them. Every
+    word is quoted, so the syntax of FTS5 (operators, column filters, quotes) can't be used by accident.
+    @param server_id: int: The server to search the questions of
+    @param terms: str: The words to search for
+    @return: str: The query, or an empty string if there are no words
+    """
+    if not (words := ' '.join('"' + word.replace('"', '""') + '"' for word in terms.split())):
+        return ''
+    # The server is part of the query, so only its questions are matched
+    return f'serverid : "{server_id}" AND {{content author}} : ({words})'
+
+
+class SearchIndex:
+    """
+    Full-text index of archived questions in an embedded SQLite database file (FTS5), so past answers can be found
+    without reading the archive channel. Like the SQLite storage, all queries run on a single database thread.
+    """
+
+    def __init__(self, path: str):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='search')
+        self._connection: Optional[sqlite3.Connection] = None
+        self._executor.submit(self._connect, path).result()
+
+    def _connect(self, path: str) -> None:
+        self._connection = sqlite3.connect(path, timeout=DB_TIMEOUT, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL;")
+        self._connection.execute("PRAGMA synchronous=NORMAL;")
+        # The text and the author are searched, within the questions of a server. The other columns are stored with it.
+        # Indexes of older versions did not index the server, they are converted in one transaction.
+        self._connection.execute("BEGIN;")
+        schema = self._connection.execute("SELECT sql FROM sqlite_master WHERE name = 'questions';").fetchone()
+        outdated = schema is not None and 'serverid UNINDEXED' in schema[0]
+        if outdated:
+            self._connection.execute("ALTER TABLE questions RENAME TO questions_old;")
+        self._connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS questions USING fts5 "
+                                 "(content, author, serverid, channel UNINDEXED, created UNINDEXED, url UNINDEXED, "
+                                 "tokenize = 'unicode61 remove_diacritics 2');")
+        if outdated:
+            self._connection.execute("INSERT INTO questions (content, author, serverid, channel, created, url) "
+                                     "SELECT content, author, serverid, channel, created, url FROM questions_old;")
+            self._connection.execute("DROP TABLE questions_old;")
+        self._connection.commit()
+
+    def _run(self, query: str, data: tuple) -> list:
+        with self._connection:  # Commits, or rolls back on an exception
+            return self._connection.execute(query, data).fetchall()
+
+    async def _execute(self, query: str, data: tuple) -> list:
+        start = time.perf_counter()
+        try:
+            rows = await asyncio.get_event_loop().run_in_executor(self._executor, self._run, query, data)
+        except sqlite3.Error:
+            metrics.observe_query(query, time.perf_counter() - start, failed=True)
+            raise
+        metrics.observe_query(query, time.perf_counter() - start)
+        return rows
+
+    async def add(self, server_id: int, channel: str, author: str, created_at: datetime.datetime, content: str,
+                  url: str) -> None:
+        """
+        Index an archived question.
+        @param server_id: int: The server the question was asked in
+        @param channel: str: Name of the queue channel the question was asked in
+        @param author: str: Name of the author of the question
+        @param created_at: datetime.datetime: When the question was asked
+        @param content: str: The text of the question and the messages that belong to it
+        @param url: str: Jump link to the archived question
+        @return:
+        """
+        await self._execute("INSERT INTO questions (content, author, serverid, channel, created, url) "
+                            "VALUES (?, ?, ?, ?, ?, ?);",
+                            (content, author, str(server_id), channel, created_at.isoformat(), url))
+
+    async def search(self, server_id: int, terms: str, limit: int = 5) -> List[SearchResult]:
+        """
+        Find the archived questions of a server that contain all given words, best matches first.
+        @param server_id: int: The server
+        @param terms: str: The words to search for
+        @param limit: int: The maximum number of results
+        @return: List[SearchResult]: The matches
+        """
+        if not (expression := _match_expression(server_id, terms)):
+            return []
+        rows = await self._execute("SELECT author, channel, created, "
+                                   "snippet(questions, 0, '**', '**', '…', 24), url FROM questions "
+                                   "WHERE questions MATCH ? ORDER BY rank LIMIT ?;", (expression, limit))
+        return [SearchResult(author, channel, datetime.datetime.fromisoformat(created), snippet, url)
+                for author, channel, created, snippet, url in rows]
+
+    async def close(self) -> None:
+        await asyncio.get_event_loop().run_in_executor(self._executor, self._connection.close)
+        self._executor.shutdown(wait=True)
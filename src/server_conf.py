@@ -1,50 +1,46 @@
-from typing import Set, Optional, Tuple
-from discord import Guild, TextChannel, Role
+import time
+from collections import OrderedDict
+from typing import Set, Optional, Dict, Tuple, List
+from discord import Guild, TextChannel, Role, Member
 
-from database_connection import execute_query
+from config import MEMBER_TTL, MEMBER_CACHE_SIZE
+from rules import Rule, Classifier, DEFAULT_RULES
+from storage import ServerRecord
+
+_DEFAULT_CLASSIFIER = Classifier(DEFAULT_RULES)  # Shared by the servers that did not configure rules
 
 
 class ServerConfiguration:
-    def __init__(self, server: Guild):
+    def __init__(self, server: Guild, record: Optional[ServerRecord] = None):
         self.server = server
         self.server_id = server.id
         self.archive: Optional[TextChannel] = None
         self.queues: Set[TextChannel] = set()
         self.roles: Set[Role] = set()
-        self.archive, self.queues, self.roles = self.request_server_conf()
+        self.role_ids: Set[int] = set()  # IDs of the manager roles
+        self.rules: Optional[List[Rule]] = None  # Message classification rules, None for the default rules
+        self.classifier = _DEFAULT_CLASSIFIER  # The rules compiled into one expression
+        # Member ID -> whether they are a manager and until when that is trusted, for members seen before, to check
+        # members by ID without looking them up. Without the members intent the bot is not told about role changes, so
+        # the answer expires. Ordered by expiry, and at most MEMBER_CACHE_SIZE members are kept.
+        self.managers: Dict[int, Tuple[bool, float]] = OrderedDict()
+        if record is not None:  # Server has a configuration (entry in database)
+            self.load(record)
 
-    def request_server_conf(self) -> Tuple[Optional[TextChannel], Set[TextChannel], Set[Role]]:
+    def load(self, record: ServerRecord) -> None:
         """
-        Request the server configuration from the database
-        @return: archive_id: Optional[int], queue_ids: List[int], role_ids: Set[int]
+        Resolve the IDs of a stored server configuration to the channels and roles of the server. Channels and roles
+        that no longer exist are left out.
+        @param record: ServerRecord: archive_id: Optional[int], queue_ids: Set[int], role_ids: Set[int],
+        rules: Optional[List[Rule]]
+        @return:
         """
-        result = execute_query("SELECT archiveid, queues, roles FROM servers WHERE serverid = %s;",
-                               (str(self.server_id),),
-                               return_result=True)
-        try:
-            archive_id, queue_ids, role_ids = result[0]
-
-            if archive_id is not None:  # Archive channel is set
-                archive_id = int(archive_id)
-                archive = self.server.get_channel(archive_id)
-            else:
-                archive = None
-            if queue_ids is not None:  # At least one queue channel is set
-                queue_ids = queue_ids.split()
-                queue_ids = set(map(int, queue_ids))
-                queues = set(map(self.server.get_channel, queue_ids))
-            else:
-                queues = set()
-            if role_ids is not None:  # At least one role is designated queue manager
-                role_ids = role_ids.split()
-                role_ids = set(map(int, role_ids))
-                roles = set(map(self.server.get_role, role_ids))
-            else:
-                roles = set()
-
-            return archive, queues, roles
-        except IndexError:  # Server has no configuration (no entry in database)
-            return None, set(), set()
+        archive_id, queue_ids, role_ids, rule_list = record
+        self.archive = self.server.get_channel(archive_id) if archive_id is not None else None
+        self.queues = set(filter(None, map(self.server.get_channel, queue_ids)))
+        self.set_roles(set(filter(None, map(self.server.get_role, role_ids))))
+        if rule_list is not None:
+            self.set_rules(rule_list)
 
     def set_archive(self, archive: Optional[TextChannel]) -> None:
         self.archive = archive
@@ -54,3 +50,79 @@ class ServerConfiguration:
 
     def set_roles(self, roles: Set[Role]) -> None:
         self.roles = roles
+        self.role_ids = {r.id for r in roles}
+        self.managers.clear()
+
+    def set_rules(self, rule_list: Optional[List[Rule]]) -> None:
+        """
+        Set the message classification rules and compile them.
+        @param rule_list: Optional[List[Rule]]: The rules, or None for the default rules
+        @return:
+        """
+        self.rules = rule_list
+        self.classifier = Classifier(rule_list) if rule_list is not None else _DEFAULT_CLASSIFIER
+
+    def classify(self, content: str) -> Optional[str]:
+        """
+        Classify a new question by the rules of the server.
+        @param content: str: The content of the question
+        @return: Optional[str]: The action of the first rule that matches, or None
+        """
+        return self.classifier.classify(content)
+
+    def is_manager(self, member: Member) -> bool:
+        """
+        Determine if member is a queue manager from their current roles. The answer is remembered for is_manager_id.
+        @param member: discord.Member: The member to check
+        @return: bool: Whether is member is a queue manager or not
+        """
+        manager = not self.role_ids.isdisjoint(r.id for r in member.roles)
+        now = time.monotonic()
+        self.managers[member.id] = (manager, now + MEMBER_TTL)
+        self.managers.move_to_end(member.id)
+        # Forget the members whose answer expired, and the least recently seen ones beyond the limit
+        while len(self.managers) > MEMBER_CACHE_SIZE or next(iter(self.managers.values()))[1] < now:
+            self.managers.popitem(last=False)
+        return manager
+
+    def is_manager_id(self, member_id: int) -> Optional[bool]:
+        """
+        Determine if a member is a queue manager without looking up the member.
+        @param member_id: int: The member to check
+        @return: Optional[bool]: Whether the member is a queue manager, or None if the member was not seen recently
+        """
+        try:
+            manager, expires = self.managers[member_id]
+        except KeyError:
+            return None
+        if expires < time.monotonic():
+            del self.managers[member_id]
+            return None
+        return manager
+
+    def forget_member(self, member_id: int) -> None:
+        """
+        Forget whether a member is a queue manager, e.g. because their roles changed.
+        @param member_id: int: The member
+        @return:
+        """
+        self.managers.pop(member_id, None)
+
+    def remove_channel(self, channel_id: int) -> None:
+        """
+        Remove a deleted channel from the configuration.
+        @param channel_id: int: The deleted channel
+        @return:
+        """
+        if self.archive is not None and self.archive.id == channel_id:
+            self.archive = None
+        self.queues = {q for q in self.queues if q.id != channel_id}
+
+    def remove_role(self, role_id: int) -> None:
+        """
+        Remove a deleted role from the configuration.
+        @param role_id: int: The deleted role
+        @return:
+        """
+        if role_id in self.role_ids:
+            self.set_roles({r for r in self.roles if r.id != role_id})
@@ -0,0 +1,131 @@
+import math
+import time
+from typing import Dict, Optional, Collection
+
+from discord.utils import DISCORD_EPOCH
+
+
+def _age(message_id: int) -> float:
+    """
+    Seconds since a message was sent, from the timestamp in its ID.
+    @param message_id: int: The message
+    @return: float: The age of the message
+    """
+    return max(time.time() - ((message_id >> 22) + DISCORD_EPOCH) / 1000, 0.0)
+
+
+class QuantileSketch:
+    """
+    Streaming estimate of the quantiles of durations. Values are counted in buckets whose bounds grow exponentially, so
+    adding a value takes constant time, memory only grows with the logarithm of the range of values, and every quantile
+    is within `relative_accuracy` of the true value.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.02, minimum: float = 0.1):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.minimum = minimum  # Values below this are counted as this value
+        self.buckets: Dict[int, int] = {}  # Bucket index -> number of values
+        self.count = 0
+
+    def add(self, value: float) -> None:
+        index = math.ceil(math.log(max(value, self.minimum)) / self._log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        @param q: float: The quantile, between 0 and 1, e.g. 0.5 for the median
+        @return: Optional[float]: The estimated value, or None if no values were added
+        """
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return 2 * self.gamma ** index / (self.gamma + 1)  # Middle of the bucket
+        return None  # Not reached
+
+
+class ChannelStats:
+    """
+    Statistics of one queue channel since the bot started.
+    """
+
+    def __init__(self):
+        self.waiting = 0  # Questions that are not claimed or archived yet
+        self.time_to_claim = QuantileSketch()  # Seconds from asking a question until it is claimed
+        self.time_to_archive = QuantileSketch()  # Seconds from asking a question until it is archived
+
+
+class QueueStats:
+    """
+    Statistics of the queue channels, kept up to date as questions are asked, claimed, archived and deleted. Every event
+    updates them in constant time, so they can be shown without reading the channels or querying the storage.
+    """
+
+    def __init__(self):
+        self.channels: Dict[int, ChannelStats] = {}  # Channel ID -> statistics
+        self.waiting: Dict[int, int] = {}  # Message ID of a waiting question -> its channel ID
+
+    def channel(self, channel_id: int) -> ChannelStats:
+        try:
+            return self.channels[channel_id]
+        except KeyError:
+            stats = self.channels[channel_id] = ChannelStats()
+            return stats
+
+    def _stop_waiting(self, message_id: int) -> None:
+        if (channel_id := self.waiting.pop(message_id, None)) is not None:
+            self.channels[channel_id].waiting -= 1
+
+    def asked(self, message_id: int, channel_id: int) -> None:
+        """
+        A new question was asked.
+        @param message_id: int: The question
+        @param channel_id: int: The queue channel
+        @return:
+        """
+        if message_id not in self.waiting:
+            self.waiting[message_id] = channel_id
+            self.channel(channel_id).waiting += 1
+
+    def claimed(self, message_id: int, channel_id: int) -> None:
+        """
+        A question was claimed by a manager.
+        @param message_id: int: The question
+        @param channel_id: int: The queue channel
+        @return:
+        """
+        self._stop_waiting(message_id)
+        self.channel(channel_id).time_to_claim.add(_age(message_id))
+
+    def archived(self, message_id: int, channel_id: int) -> None:
+        """
+        A question was archived.
+        @param message_id: int: The question
+        @param channel_id: int: The queue channel
+        @return:
+        """
+        self._stop_waiting(message_id)
+        self.channel(channel_id).time_to_archive.add(_age(message_id))
+
+    def removed(self, message_id: int) -> None:
+        """
+        A message was deleted. If it is a waiting question, it no longer is.
+        @param message_id: int: The message
+        @return:
+        """
+        self._stop_waiting(message_id)
+
+    def forget_channels(self, channel_ids: Collection[int]) -> None:
+        """
+        Stop counting the waiting questions of some channels, e.g. those of a shard that reconnected, as they may have
+        been claimed or deleted in the meantime.
+        @param channel_ids: Collection[int]: The channels
+        @return:
+        """
+        for message_id in [m for m, c in self.waiting.items() if c in channel_ids]:
+            self._stop_waiting(message_id)
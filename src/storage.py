@@ -0,0 +1,364 @@
+import asyncio
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Set, Tuple, Dict, Iterable, List, Iterator
+
+import metrics
+import rules
+from config import STORAGE, SQLITE_PATH, DB_TIMEOUT
+from rules import Rule
+
+ServerRecord = Tuple[Optional[int], Set[int], Set[int], Optional[List[Rule]]]  # archive_id, queue_ids, role_ids, rules
+Claim = Tuple[int, int, int]  # owner_id, server_id, channel_id
+
+
+def _parse_server_row(row: Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]) -> ServerRecord:
+    """
+    Convert a row from the servers table to IDs and rules.
+    @param row: Tuple: archiveid, queues, roles and rules columns as stored in the database
+    @return: ServerRecord: archive_id: Optional[int], queue_ids: Set[int], role_ids: Set[int],
+    rules: Optional[List[Rule]]
+    """
+    archive_id, queue_ids, role_ids, rule_list = row
+    archive_id = int(archive_id) if archive_id is not None else None  # Archive channel is set
+    queue_ids = set(map(int, queue_ids.split())) if queue_ids is not None else set()  # At least one queue is set
+    role_ids = set(map(int, role_ids.split())) if role_ids is not None else set()  # At least one manager role is set
+    return archive_id, queue_ids, role_ids, rules.loads(rule_list)  # None if the server did not configure rules
+
+
+def _join_ids(ids: Iterable[int]) -> str:
+    return " ".join(map(str, ids))
+
+
+def _chunks(items: List[str], size: int = 500) -> Iterator[List[str]]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class Storage:
+    """
+    Interface to the persistent state of the bot: the configuration of each server and the owners of claimed messages.
+    """
+
+    async def get_servers(self, server_ids: Iterable[int]) -> Dict[int, ServerRecord]:
+        """
+        Get the configurations of many servers at once.
+        @param server_ids: Iterable[int]: The servers to get the configuration of
+        @return: Dict[int, ServerRecord]: The configuration of each server that has one
+        """
+        raise NotImplementedError
+
+    async def set_archive(self, server_id: int, archive_id: int) -> None:
+        """
+        Set the archive channel of a server.
+        @param server_id: int: The server to configure
+        @param archive_id: int: The channel to use as archive
+        @return:
+        """
+        raise NotImplementedError
+
+    async def set_queues(self, server_id: int, queue_ids: Set[int]) -> None:
+        """
+        Set the queue channels of a server.
+        @param server_id: int: The server to configure
+        @param queue_ids: Set[int]: The channels to use as queues
+        @return:
+        """
+        raise NotImplementedError
+
+    async def set_roles(self, server_id: int, role_ids: Set[int]) -> None:
+        """
+        Set the queue manager roles of a server.
+        @param server_id: int: The server to configure
+        @param role_ids: Set[int]: The roles that can manage queues
+        @return:
+        """
+        raise NotImplementedError
+
+    async def set_rules(self, server_id: int, rule_list: Optional[List[Rule]]) -> None:
+        """
+        Set the message classification rules of a server.
+        @param server_id: int: The server to configure
+        @param rule_list: Optional[List[Rule]]: The rules, or None to use the default rules
+        @return:
+        """
+        raise NotImplementedError
+
+    async def delete_server(self, server_id: int) -> None:
+        """
+        Delete the configuration of a server.
+        @param server_id: int: The server to delete the configuration of
+        @return:
+        """
+        raise NotImplementedError
+
+    async def get_claims(self, server_ids: Iterable[int]) -> Dict[int, Claim]:
+        """
+        Get the claimed messages of many servers at once.
+        @param server_ids: Iterable[int]: The servers to get the claimed messages of
+        @return: Dict[int, Claim]: Maps message IDs to their owner, server and channel
+        """
+        raise NotImplementedError
+
+    async def write_claims(self, claims: Dict[int, Optional[Claim]]) -> None:
+        """
+        Persist a batch of changes to the claimed messages in one go.
+        @param claims: Dict[int, Optional[Claim]]: Maps message IDs to their owner, server and channel, or None to
+        forget them
+        @return:
+        """
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        """
+        Release the resources held by the storage.
+        @return:
+        """
+        pass
+
+
+class MemoryStorage(Storage):
+    """
+    Storage that keeps everything in memory. Nothing is persisted between sessions.
+    """
+
+    def __init__(self):
+        self.servers: Dict[int, ServerRecord] = {}
+        self.claims: Dict[int, Claim] = {}
+
+    def _server(self, server_id: int) -> ServerRecord:
+        return self.servers.setdefault(server_id, (None, set(), set(), None))
+
+    async def get_servers(self, server_ids: Iterable[int]) -> Dict[int, ServerRecord]:
+        return {s_id: self.servers[s_id] for s_id in server_ids if s_id in self.servers}
+
+    async def set_archive(self, server_id: int, archive_id: int) -> None:
+        _, queue_ids, role_ids, rule_list = self._server(server_id)
+        self.servers[server_id] = archive_id, queue_ids, role_ids, rule_list
+
+    async def set_queues(self, server_id: int, queue_ids: Set[int]) -> None:
+        archive_id, _, role_ids, rule_list = self._server(server_id)
+        self.servers[server_id] = archive_id, set(queue_ids), role_ids, rule_list
+
+    async def set_roles(self, server_id: int, role_ids: Set[int]) -> None:
+        archive_id, queue_ids, _, rule_list = self._server(server_id)
+        self.servers[server_id] = archive_id, queue_ids, set(role_ids), rule_list
+
+    async def set_rules(self, server_id: int, rule_list: Optional[List[Rule]]) -> None:
+        archive_id, queue_ids, role_ids, _ = self._server(server_id)
+        self.servers[server_id] = archive_id, queue_ids, role_ids, list(rule_list) if rule_list is not None else None
+
+    async def delete_server(self, server_id: int) -> None:
+        self.servers.pop(server_id, None)
+
+    async def get_claims(self, server_ids: Iterable[int]) -> Dict[int, Claim]:
+        server_ids = set(server_ids)
+        return {m: claim for m, claim in self.claims.items() if claim[1] in server_ids}
+
+    async def write_claims(self, claims: Dict[int, Optional[Claim]]) -> None:
+        for message_id, claim in claims.items():
+            if claim is None:
+                self.claims.pop(message_id, None)
+            else:
+                self.claims[message_id] = claim
+
+
+class SQLiteStorage(Storage):
+    """
+    Storage in an embedded SQLite database file, in WAL mode. All queries run on a single database thread. Several
+    processes can share the file; a process waits up to DB_TIMEOUT seconds for another one to finish writing.
+    """
+
+    def __init__(self, path: str):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        self._connection: Optional[sqlite3.Connection] = None
+        self._executor.submit(self._connect, path).result()
+
+    def _connect(self, path: str) -> None:
+        self._connection = sqlite3.connect(path, timeout=DB_TIMEOUT, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL;")
+        self._connection.execute("PRAGMA synchronous=NORMAL;")  # Safe in WAL mode, avoids an fsync per commit
+        self._connection.execute("CREATE TABLE IF NOT EXISTS servers "
+                                 "(serverid TEXT PRIMARY KEY, archiveid TEXT, queues TEXT, roles TEXT, rules TEXT);")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS messages "
+                                 "(messageid TEXT PRIMARY KEY, ownerid TEXT, serverid TEXT, channelid TEXT);")
+        # Columns that are missing if the tables were created by an older version
+        for table, column in (('servers', 'rules'), ('messages', 'serverid'), ('messages', 'channelid')):
+            if column not in [c[1] for c in self._connection.execute(f"PRAGMA table_info({table});")]:
+                self._connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} TEXT;")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS messages_serverid ON messages (serverid);")
+        self._connection.commit()
+
+    def _run(self, query: str, data: Tuple = ()) -> Tuple[list, int]:
+        """
+        Execute the given query. Runs on the database thread.
+        @return: Tuple[list, int]: The resulting rows and the number of rows affected
+        """
+        with self._connection:  # Commits, or rolls back on an exception
+            cursor = self._connection.execute(query, data)
+            return cursor.fetchall(), cursor.rowcount
+
+    async def _in_thread(self, query: str, function, *args):
+        """
+        Run a function on the database thread and record how long the query took.
+        @param query: str: The query the function runs, to label the metrics with
+        @return: The result of the function
+        """
+        start = time.perf_counter()
+        try:
+            result = await asyncio.get_event_loop().run_in_executor(self._executor, function, *args)
+        except sqlite3.Error:
+            metrics.observe_query(query, time.perf_counter() - start, failed=True)
+            raise
+        metrics.observe_query(query, time.perf_counter() - start)
+        return result
+
+    async def _execute(self, query: str, data: Tuple = ()) -> Tuple[list, int]:
+        return await self._in_thread(query, self._run, query, data)
+
+    async def get_servers(self, server_ids: Iterable[int]) -> Dict[int, ServerRecord]:
+        servers = {}
+        for chunk in _chunks(list(map(str, server_ids))):
+            rows, _ = await self._execute(f"SELECT serverid, archiveid, queues, roles, rules FROM servers "
+                                          f"WHERE serverid IN ({', '.join('?' * len(chunk))});",
+                                          tuple(chunk))
+            servers.update((int(row[0]), _parse_server_row(row[1:])) for row in rows)
+        return servers
+
+    async def _upsert(self, server_id: int, column: str, value: Optional[str]) -> None:
+        await self._execute(f"INSERT INTO servers (serverid, {column}) VALUES (?, ?) "
+                            f"ON CONFLICT(serverid) DO UPDATE SET {column} = excluded.{column};",
+                            (str(server_id), value))
+
+    async def set_archive(self, server_id: int, archive_id: int) -> None:
+        await self._upsert(server_id, 'archiveid', str(archive_id))
+
+    async def set_queues(self, server_id: int, queue_ids: Set[int]) -> None:
+        await self._upsert(server_id, 'queues', _join_ids(queue_ids))
+
+    async def set_roles(self, server_id: int, role_ids: Set[int]) -> None:
+        await self._upsert(server_id, 'roles', _join_ids(role_ids))
+
+    async def set_rules(self, server_id: int, rule_list: Optional[List[Rule]]) -> None:
+        await self._upsert(server_id, 'rules', rules.dumps(rule_list) if rule_list is not None else None)
+
+    async def delete_server(self, server_id: int) -> None:
+        await self._execute("DELETE FROM servers WHERE serverid = ?;", (str(server_id),))
+
+    def _write_claims(self, claims: Dict[int, Optional[Claim]]) -> None:
+        with self._connection:  # One transaction for the whole batch
+            self._connection.executemany("DELETE FROM messages WHERE messageid = ?;",
+                                         [(str(m),) for m, c in claims.items() if c is None])
+            self._connection.executemany("INSERT OR REPLACE INTO messages (messageid, ownerid, serverid, channelid) "
+                                         "VALUES (?, ?, ?, ?);",
+                                         [(str(m), *map(str, c)) for m, c in claims.items() if c is not None])
+
+    async def get_claims(self, server_ids: Iterable[int]) -> Dict[int, Claim]:
+        claims = {}
+        for chunk in _chunks(list(map(str, server_ids))):
+            rows, _ = await self._execute(f"SELECT messageid, ownerid, serverid, channelid FROM messages "
+                                          f"WHERE serverid IN ({', '.join('?' * len(chunk))}) "
+                                          f"AND channelid IS NOT NULL;",
+                                          tuple(chunk))
+            claims.update((int(row[0]), (int(row[1]), int(row[2]), int(row[3]))) for row in rows)
+        return claims
+
+    async def write_claims(self, claims: Dict[int, Optional[Claim]]) -> None:
+        await self._in_thread("INSERT INTO messages", self._write_claims, claims)
+
+    async def close(self) -> None:
+        await asyncio.get_event_loop().run_in_executor(self._executor, self._connection.close)
+        self._executor.shutdown(wait=True)
+
+
+class MySQLStorage(Storage):
+    """
+    Storage in the MySQL database described in the README, through the pooled connections of database_connection.
+    """
+
+    def __init__(self):
+        import database_connection  # Only require mysql-connector when MySQL is used
+        self.db = database_connection
+
+    async def get_servers(self, server_ids: Iterable[int]) -> Dict[int, ServerRecord]:
+        servers = {}
+        for chunk in _chunks(list(map(str, server_ids))):
+            result = await self.db.execute_query_async(f"SELECT serverid, archiveid, queues, roles, rules FROM servers "
+                                                       f"WHERE serverid IN ({', '.join(['%s'] * len(chunk))});",
+                                                       tuple(chunk),
+                                                       return_result=True)
+            if result is None:
+                raise ConnectionError("Could not load the server configurations from the database")
+            servers.update((int(row[0]), _parse_server_row(row[1:])) for row in result)
+        return servers
+
+    async def _upsert(self, server_id: int, column: str, value: Optional[str]) -> None:
+        if await self.db.execute_query_async(f"INSERT INTO servers "
+                                             f"(serverid, {column}) VALUES (%s, %s) "
+                                             f"ON DUPLICATE KEY UPDATE {column} = VALUES({column})",
+                                             (str(server_id), value),
+                                             return_cursor_count=True) is None:
+            raise ConnectionError("Could not save the server configuration to the database")
+
+    async def set_archive(self, server_id: int, archive_id: int) -> None:
+        await self._upsert(server_id, 'archiveid', str(archive_id))
+
+    async def set_queues(self, server_id: int, queue_ids: Set[int]) -> None:
+        await self._upsert(server_id, 'queues', _join_ids(queue_ids))
+
+    async def set_roles(self, server_id: int, role_ids: Set[int]) -> None:
+        await self._upsert(server_id, 'roles', _join_ids(role_ids))
+
+    async def set_rules(self, server_id: int, rule_list: Optional[List[Rule]]) -> None:
+        await self._upsert(server_id, 'rules', rules.dumps(rule_list) if rule_list is not None else None)
+
+    async def delete_server(self, server_id: int) -> None:
+        if await self.db.execute_query_async("DELETE FROM servers WHERE serverid = %s", (str(server_id),),
+                                             return_cursor_count=True) is None:
+            raise ConnectionError("Could not delete the server configuration from the database")
+
+    async def get_claims(self, server_ids: Iterable[int]) -> Dict[int, Claim]:
+        claims = {}
+        for chunk in _chunks(list(map(str, server_ids))):
+            result = await self.db.execute_query_async(f"SELECT messageid, ownerid, serverid, channelid FROM messages "
+                                                       f"WHERE serverid IN ({', '.join(['%s'] * len(chunk))}) "
+                                                       f"AND channelid IS NOT NULL;",
+                                                       tuple(chunk),
+                                                       return_result=True)
+            if result is None:
+                raise ConnectionError("Could not load the claimed messages from the database")
+            claims.update((int(row[0]), (int(row[1]), int(row[2]), int(row[3]))) for row in result)
+        return claims
+
+    async def write_claims(self, claims: Dict[int, Optional[Claim]]) -> None:
+        removed = [(str(m),) for m, c in claims.items() if c is None]
+        claimed = [(str(m), *map(str, c)) for m, c in claims.items() if c is not None]
+        if removed and await self.db.execute_many_async("DELETE FROM messages WHERE messageid = %s",
+                                                        removed) is None:
+            raise ConnectionError("Could not remove claimed messages from the database")
+        if claimed and await self.db.execute_many_async("INSERT INTO messages "
+                                                        "(messageid, ownerid, serverid, channelid) "
+                                                        "VALUES (%s, %s, %s, %s) "
+                                                        "ON DUPLICATE KEY UPDATE ownerid = VALUES(ownerid), "
+                                                        "serverid = VALUES(serverid), channelid = VALUES(channelid)",
+                                                        claimed) is None:
+            raise ConnectionError("Could not add claimed messages to the database")
+
+    async def close(self) -> None:
+        await asyncio.get_event_loop().run_in_executor(None, self.db.close)
+
+
+def create_storage(kind: str = STORAGE) -> Storage:
+    """
+    Create the storage backend of the given kind.
+    @param kind: str: 'mysql', 'sqlite' or 'memory'
+    @return: Storage: The storage backend
+    """
+    if kind == 'mysql':
+        return MySQLStorage()
+    if kind == 'sqlite':
+        return SQLiteStorage(SQLITE_PATH)
+    if kind == 'memory':
+        return MemoryStorage()
+    raise ValueError(f"Unknown storage backend: {kind}")
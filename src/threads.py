@@ -0,0 +1,149 @@
+from typing import Dict, Optional, Tuple, List, Collection
+from discord import Message
+
+FollowUp = Tuple[int, int, str, str]  # message_id, author_id, field name, content
+
+
+class QuestionThread:
+    """
+    A question in a queue channel together with the follow-up messages that belong to it.
+    """
+
+    def __init__(self, message: Message):
+        self.root_id = message.id
+        self.channel_id = message.channel.id
+        self.author_id = message.author.id
+        # How the author is shown in the archive, as they were when they asked, so archiving needs no requests
+        self.author_name = message.author.display_name
+        self.author_tag = str(message.author)  # Name#discriminator
+        self.author_avatar_url = str(message.author.avatar_url)
+        self.content = message.content
+        self.action: Optional[str] = None  # Action of the classification rule the question matches, if any
+        self.follow_ups: Dict[int, FollowUp] = {}  # In the order they were sent
+
+    def add(self, message: Message, name: str) -> None:
+        self.follow_ups[message.id] = (message.id, message.author.id, name, message.content)
+
+    def messages(self) -> List[FollowUp]:
+        return list(self.follow_ups.values())
+
+
+class QuestionThreads:
+    """
+    Index of the open questions in queue channels. Follow-ups, replies and mentions are attached to their question as
+    they are sent, so archiving a question does not have to search the channel history.
+    """
+
+    def __init__(self, max_threads: int = 10000):
+        self.max_threads = max_threads
+        self.threads: Dict[int, QuestionThread] = {}  # Root message ID -> thread, oldest first
+        self.latest: Dict[Tuple[int, int], int] = {}  # (channel ID, author ID) -> root ID of their latest question
+        self.roots: Dict[int, int] = {}  # Message ID of a follow-up -> root ID of its thread
+
+    def open(self, message: Message) -> QuestionThread:
+        """
+        Start a thread for a new question.
+        @param message: discord.Message: The question
+        @return: QuestionThread: The new thread
+        """
+        thread = self.threads[message.id] = QuestionThread(message)
+        self.latest[(thread.channel_id, thread.author_id)] = thread.root_id
+        if len(self.threads) > self.max_threads:  # Forget the oldest question
+            self.pop(next(iter(self.threads)))
+        return thread
+
+    def _thread_of_author(self, channel_id: int, author_id: int) -> Optional[QuestionThread]:
+        root_id = self.latest.get((channel_id, author_id))
+        return self.threads.get(root_id) if root_id is not None else None
+
+    def _author_of(self, message_id: int) -> Optional[int]:
+        if message_id in self.threads:
+            return self.threads[message_id].author_id
+        if (root_id := self.roots.get(message_id)) is not None:
+            return self.threads[root_id].follow_ups[message_id][1]
+        return None
+
+    def attach(self, message: Message) -> Optional[QuestionThread]:
+        """
+        Attach a message to the question it belongs to: the latest question of the same author, or of the author it
+        replies to or mentions.
+        @param message: discord.Message: A message in a queue channel that is not a new question
+        @return: Optional[QuestionThread]: The thread the message is attached to, if any
+        """
+        channel_id = message.channel.id
+        if (thread := self._thread_of_author(channel_id, message.author.id)) is not None:
+            # Add messages from the same user to the chain
+            name = f"{message.author.display_name}:"
+        elif message.reference is not None:
+            # Add messages that reply to the question's author
+            if isinstance(ref := message.reference.resolved, Message):
+                ref_author_id = ref.author.id
+            else:  # Referenced message is not in the message cache, look it up in the index
+                ref_author_id = self._author_of(message.reference.message_id)
+            if ref_author_id is None or (thread := self._thread_of_author(channel_id, ref_author_id)) is None:
+                return None
+            name = f"{message.author.display_name} replied:"
+        else:
+            # Add messages that mention the author of the question
+            for user in message.mentions:
+                if (thread := self._thread_of_author(channel_id, user.id)) is not None:
+                    break
+            else:
+                return None
+            name = f"{message.author.display_name}:"
+        thread.add(message, name)
+        self.roots[message.id] = thread.root_id
+        return thread
+
+    def edit(self, message_id: int, content: str) -> None:
+        """
+        Update the content of an indexed message that was edited.
+        @param message_id: int: The edited message
+        @param content: str: The new content
+        @return:
+        """
+        if message_id in self.threads:
+            self.threads[message_id].content = content
+        elif (root_id := self.roots.get(message_id)) is not None:
+            thread = self.threads[root_id]
+            _, author_id, name, _ = thread.follow_ups[message_id]
+            thread.follow_ups[message_id] = (message_id, author_id, name, content)
+
+    def remove(self, message_id: int) -> None:
+        """
+        Remove a message that was deleted. If it is a question, its whole thread is forgotten.
+        @param message_id: int: The deleted message
+        @return:
+        """
+        if message_id in self.threads:
+            self.pop(message_id)
+        elif (root_id := self.roots.pop(message_id, None)) is not None:
+            del self.threads[root_id].follow_ups[message_id]
+
+    def get(self, root_id: int) -> Optional[QuestionThread]:
+        return self.threads.get(root_id)
+
+    def pop(self, root_id: int) -> Optional[QuestionThread]:
+        """
+        Remove a question and its follow-ups from the index.
+        @param root_id: int: The question
+        @return: Optional[QuestionThread]: The thread of the question, or None if it was not indexed
+        """
+        thread = self.threads.pop(root_id, None)
+        if thread is None:
+            return None
+        key = (thread.channel_id, thread.author_id)
+        if self.latest.get(key) == root_id:
+            del self.latest[key]
+        for message_id in thread.follow_ups:
+            self.roots.pop(message_id, None)
+        return thread
+
+    def forget_channels(self, channel_ids: Collection[int]) -> None:
+        """
+        Forget the questions in some channels, e.g. those of a shard that reconnected.
+        @param channel_ids: Collection[int]: The channels
+        @return:
+        """
+        for root_id in [t.root_id for t in self.threads.values() if t.channel_id in channel_ids]:
+            self.pop(root_id)
@@ -0,0 +1,64 @@
+"""
+Unit tests of the admission control: when servers are degraded, and when their events are dropped.
+
+Usage (from the repository root):
+    python -m unittest discover tests
+"""
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from admission import Admission  # noqa: E402
+
+
+class AdmissionTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.backlog = 0.0
+        self.admission = Admission(concurrency=1, max_depth=4, degrade_latency=1.0, smoothing=1.0,
+                                   backlog=lambda guild_id: self.backlog)
+        self.stderr = contextlib.redirect_stderr(io.StringIO())
+        self.stderr.__enter__()
+
+    def tearDown(self):
+        self.stderr.__exit__(None, None, None)
+
+    async def test_degraded_before_dropping(self):
+        self.assertTrue(await self.admission.enter(1))
+        waiting = [asyncio.ensure_future(self.admission.enter(1)) for _ in range(4)]
+        await asyncio.sleep(0)
+        self.assertTrue(self.admission.degraded(1))
+        self.assertFalse(await self.admission.enter(1))
+        for _ in waiting:
+            self.admission.leave(1, 0.0)
+            await asyncio.sleep(0)
+        self.assertTrue(all(task.result() for task in waiting))
+        self.admission.leave(1, 0.0)
+        self.assertFalse(self.admission.degraded(1))
+
+    async def test_outbound_backlog_degrades(self):
+        await self.admission.enter(1)
+        self.backlog = 5.0
+        self.admission.leave(1, 0.0)
+        self.assertTrue(self.admission.degraded(1))
+        await self.admission.enter(1)
+        self.backlog = 0.0
+        self.admission.leave(1, 0.0)
+        self.assertFalse(self.admission.degraded(1))
+
+    async def test_latency_kept_while_idle(self):
+        self.admission.smoothing = 0.5
+        await self.admission.enter(1)
+        self.admission.leave(1, 1.0)
+        self.assertEqual(self.admission.gates[1].latency, 0.5)
+        await self.admission.enter(1)
+        self.admission.leave(1, 2.0)
+        self.assertTrue(self.admission.degraded(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""
+Tests of archiving questions, driven through the event handlers of the bot with the fakes of the benchmark.
+
+Usage (from the repository root):
+    python -m unittest discover tests
+"""
+import asyncio
+import os
+import sys
+import unittest
+import unittest.mock
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+import discord  # noqa: E402
+
+from fakes import Calls, CountingStorage, FakeGuild  # noqa: E402
+from QueueManager import QueueManager  # noqa: E402
+from search_index import SearchIndex  # noqa: E402
+
+
+class ArchiveTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.guild = FakeGuild('server', Calls())
+        self.archive = self.guild.add_channel('archive')
+        self.queue = self.guild.add_channel('questions')
+        role = self.guild.add_role('TA')
+        self.student = self.guild.add_member('student')
+        self.manager = self.guild.add_member('ta', [role])
+        storage = CountingStorage(Calls())
+        await storage.set_archive(self.guild.id, self.archive.id)
+        await storage.set_queues(self.guild.id, {self.queue.id})
+        await storage.set_roles(self.guild.id, {role.id})
+        self.bot = QueueManager(storage=storage, search_index=SearchIndex(':memory:'), command_prefix='?',
+                                intents=discord.Intents.default())
+        self.bot.outbound.limits = {}
+        self.bot._connection.user = self.guild.me
+        self.guild.client = self.bot
+        self.bot._connection._guilds[self.guild.id] = self.guild
+        await self.bot.load_server_confs([self.guild])
+
+    async def asyncTearDown(self):
+        await self.bot.close()
+
+    async def ask_and_archive(self):
+        """
+        A student asks a question, a manager replies to it, claims it and archives it.
+        @return: FakeMessage: The question
+        """
+        question = self.queue.post(self.student, "The printer is on fire")
+        await self.bot.on_message(question)
+        await self.bot.on_message(self.queue.post(self.manager, "Have you tried water?", reference=question))
+        await self.bot.on_raw_reaction_add(question.react('📥', self.manager))
+        await self.bot.on_raw_reaction_add(question.react('📤', self.manager))
+        await asyncio.gather(*self.bot.archive_tasks)
+        return question
+
+    async def test_archive_indexes_author_of_question(self):
+        await self.ask_and_archive()
+        results = await self.bot.search_index.search(self.guild.id, 'printer')
+        self.assertEqual([result.author for result in results], ["student (student#0001)"])
+        self.assertIn("ta replied:", (await self.bot.search_index.search(self.guild.id, 'water'))[0].snippet)
+
+    async def test_search_is_limited_to_server(self):
+        await self.ask_and_archive()
+        other = FakeGuild('other', Calls())
+        await self.bot.search_index.add(other.id, 'questions', "other (other#0001)", datetime.utcnow(), "printer",
+                                        "url")
+        results = await self.bot.search_index.search(self.guild.id, 'printer')
+        self.assertEqual([result.author for result in results], ["student (student#0001)"])
+        self.assertEqual(len(await self.bot.search_index.search(other.id, 'printer')), 1)
+        self.assertEqual(await self.bot.search_index.search(other.id, str(other.id)), [])  # Not a searched column
+
+    async def test_shed_follow_up_is_archived(self):
+        question = self.queue.post(self.student, "The printer is on fire")
+        await self.bot.on_message(question)
+        self.bot.admission.max_depth = 0  # Shed every message from now on
+        await self.bot.on_message(self.queue.post(self.student, "It is spreading"))
+        await self.bot.on_raw_reaction_add(question.react('📥', self.manager))
+        await self.bot.on_raw_reaction_add(question.react('📤', self.manager))
+        await asyncio.gather(*self.bot.archive_tasks)
+        self.assertEqual([m for m in self.queue.messages.values() if m.author != self.guild.me], [])
+        self.assertEqual(len(await self.bot.search_index.search(self.guild.id, 'printer spreading')), 1)
+
+    async def test_archive_again_after_failed_post(self):
+        question = self.queue.post(self.student, "The printer is on fire")
+        await self.bot.on_message(question)
+        await self.bot.on_message(self.queue.post(self.student, "It is spreading"))
+        await self.bot.on_raw_reaction_add(question.react('📥', self.manager))
+        send, self.archive.send = self.archive.send, unittest.mock.AsyncMock(side_effect=discord.HTTPException(
+            unittest.mock.Mock(status=500, reason='Internal Server Error'), 'Internal Server Error'))
+        await self.bot.on_raw_reaction_add(question.react('📤', self.manager))
+        await asyncio.gather(*self.bot.archive_tasks)
+        self.assertEqual(len([m for m in self.queue.messages.values() if m.author == self.student]), 2)
+        self.archive.send = send
+        await self.bot.on_raw_reaction_add(question.react('📤', self.manager))
+        await asyncio.gather(*self.bot.archive_tasks)
+        self.assertEqual([m for m in self.queue.messages.values() if m.author != self.guild.me], [])
+        self.assertEqual(self.guild.calls.counts['get_messages'], 1)  # Only the backfill, the thread was kept
+
+
+if __name__ == '__main__':
+    unittest.main()
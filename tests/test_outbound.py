@@ -0,0 +1,140 @@
+"""
+Unit tests of the outbound pipelines: combining operations on the same message, cancelling operations that became
+unnecessary, promoting waiting operations, and the order of embeds.
+
+Usage (from the repository root):
+    python -m unittest discover tests
+"""
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from outbound import Outbound, HIGH, NORMAL, LOW  # noqa: E402
+
+
+class FakeChannel:
+    """
+    Records the requests made to it and to its messages, in the order they were made.
+    """
+
+    def __init__(self, channel_id: int = 1):
+        self.id = channel_id
+        self.calls = []
+
+    async def send(self, content=None, embed=None):
+        await asyncio.sleep(0.01 if embed == 0 else 0)  # The first embed takes longest
+        self.calls.append(('send', embed))
+
+    async def delete_messages(self, messages):
+        self.calls.append(('delete', sorted(m.id for m in messages)))
+
+
+class FakeMessage:
+    def __init__(self, channel: FakeChannel, message_id: int):
+        self.channel = channel
+        self.id = message_id
+
+    async def add_reaction(self, emoji):
+        self.channel.calls.append(('add', self.id, emoji))
+
+    async def remove_reaction(self, emoji, member):
+        self.channel.calls.append(('remove', self.id, emoji))
+
+    async def clear_reaction(self, emoji):
+        self.channel.calls.append(('clear', self.id, emoji))
+
+    async def clear_reactions(self):
+        self.channel.calls.append(('clear_all', self.id))
+
+
+class FakeMember:
+    id = 42
+
+
+class OutboundTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.outbound = Outbound(limits={})
+        self.channel = FakeChannel()
+        # Recent snowflakes, so deletes are done in bulk
+        self.message = FakeMessage(self.channel, 2 ** 62)
+        self.other = FakeMessage(self.channel, 2 ** 62 + 1)
+
+    async def test_coalesce_waiting_operation(self):
+        first = self.outbound.add_reaction(self.message, '📥')
+        second = self.outbound.add_reaction(self.message, '📥')
+        self.assertIs(first, second)
+        await self.outbound.close()
+        self.assertEqual(self.channel.calls, [('add', self.message.id, '📥')])
+
+    async def test_no_coalesce_across_conflicting_operation(self):
+        self.outbound.add_reaction(self.message, '✅')
+        self.outbound.remove_reaction(self.message, '✅', FakeMember())
+        self.outbound.add_reaction(self.message, '✅')
+        await self.outbound.close()
+        self.assertEqual(self.channel.calls, [('add', self.message.id, '✅'), ('remove', self.message.id, '✅'),
+                                              ('add', self.message.id, '✅')])
+
+    async def test_coalesce_across_other_reaction(self):
+        first = self.outbound.add_reaction(self.message, '📤')
+        self.outbound.remove_reaction(self.message, '✅', FakeMember())
+        self.assertIs(self.outbound.add_reaction(self.message, '📤'), first)
+        await self.outbound.close()
+        self.assertEqual(self.channel.calls, [('add', self.message.id, '📤'), ('remove', self.message.id, '✅')])
+
+    async def test_clear_reaction_cancels_changes_of_that_reaction(self):
+        add = self.outbound.add_reaction(self.message, '📥')
+        remove = self.outbound.remove_reaction(self.message, '📥', FakeMember())
+        other = self.outbound.add_reaction(self.message, '📤')
+        self.outbound.clear_reaction(self.message, '📥')
+        await self.outbound.close()
+        self.assertIsNone(await add)
+        self.assertIsNone(await remove)
+        self.assertTrue(other.done())
+        self.assertEqual(self.channel.calls, [('add', self.message.id, '📤'), ('clear', self.message.id, '📥')])
+
+    async def test_delete_cancels_reaction_changes(self):
+        self.outbound.add_reaction(self.message, '📥')
+        self.outbound.add_reaction(self.other, '📥')
+        self.outbound.delete(self.channel, self.message.id)
+        await self.outbound.close()
+        self.assertEqual(self.channel.calls, [('add', self.other.id, '📥'), ('delete', [self.message.id])])
+
+    async def test_waiting_deletes_are_combined(self):
+        self.outbound.delete(self.channel, self.message.id)
+        self.outbound.delete(self.channel, self.other.id)
+        await self.outbound.close()
+        self.assertEqual(self.channel.calls, [('delete', [self.message.id, self.other.id])])
+
+    async def test_priority_order(self):
+        self.outbound.add_reaction(self.message, '1', LOW)
+        self.outbound.add_reaction(self.other, '2', HIGH)
+        await self.outbound.close()
+        self.assertEqual(self.channel.calls, [('add', self.other.id, '2'), ('add', self.message.id, '1')])
+
+    async def test_promotion_keeps_order_on_message(self):
+        self.outbound.add_reaction(self.message, '1', LOW)
+        self.outbound.add_reaction(self.other, '2', NORMAL)
+        self.outbound.add_reaction(self.message, '3', HIGH)
+        await self.outbound.close()
+        self.assertEqual(self.channel.calls, [('add', self.message.id, '1'), ('add', self.message.id, '3'),
+                                              ('add', self.other.id, '2')])
+
+    async def test_length_counts_waiting_operations_once(self):
+        self.outbound.add_reaction(self.message, '1', LOW)
+        self.outbound.add_reaction(self.message, '1', HIGH)  # Promoted
+        self.outbound.add_reaction(self.other, '2')
+        self.outbound.clear_reaction(self.other, '2')  # Cancels the addition
+        self.assertEqual(len(self.outbound), 2)
+        await self.outbound.close()
+        self.assertEqual(len(self.outbound), 0)
+
+    async def test_embeds_keep_order(self):
+        await asyncio.gather(*(self.outbound.send_embed(self.channel, i) for i in range(5)))
+        self.assertEqual(self.channel.calls, [('send', i) for i in range(5)])
+
+
+if __name__ == '__main__':
+    unittest.main()